@@ -4,9 +4,10 @@
 # their CMSSW implementations mainly in RecoLocalCalo/HGCalRecAlgos
 ##############################################################################
 from __future__ import print_function
-# needed for ROOT funcs/types
-import ROOT
 import math
+# needed to run the layers in parallel
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 # needed for KDTree indexing & searches
 import numpy as np
 from scipy import spatial
@@ -62,6 +63,120 @@ class Hexel:
     def __gt__(self, other_rho):
         return self.rho > other_rho
 
+
+# definition of the store of the hexels of one event: one array per attribute, hits ordered by layerID
+# (or of several events: hits ordered by event then layerID, with the offsets of each (event, layerID))
+class HitStore(object):
+
+    # attributes taken from the rechits: name, rechit method and type
+    inputs = (('eta', 'eta', np.float64), ('phi', 'phi', np.float64), ('x', 'x', np.float64), ('y', 'y', np.float64),
+              ('z', 'z', np.float64), ('time', 'time', np.float64), ('isHalfCell', 'isHalf', np.bool_),
+              ('weight', 'energy', np.float64), ('detid', 'detid', np.int64), ('layer', 'layer', np.int64),
+              ('thickness', 'thickness', np.float64), ('clusterRECOIndex', 'cluster2d', np.int64))
+    # attributes set by the clustering: name, type and initial value (as for Hexel)
+    outputs = (('sigmaNoise', np.float64, 0.), ('rho', np.float64, 0.), ('delta', np.float64, 0.),
+               ('nearestHigher', np.int64, -1), ('clusterIndex', np.int64, -1), ('isBorder', np.bool_, False),
+               ('isHalo', np.bool_, False))
+    columns = tuple(name for name, method, dtype in inputs) + tuple(name for name, dtype, value in outputs)
+
+    # columns: dictionary of arrays already ordered by layerID, offsets: first hit of each layerID (and the end)
+    def __init__(self, layerID, offsets, columns):
+        self.layerID = layerID
+        self.offsets = offsets
+        for name, method, dtype in self.inputs:
+            setattr(self, name, columns[name])
+        for name, dtype, value in self.outputs:
+            if name in columns:
+                setattr(self, name, columns[name])
+            else:
+                setattr(self, name, np.full(len(layerID), value, dtype=dtype))
+
+    # make the store out of unordered columns (the hits of each layerID keep their order)
+    @classmethod
+    def fromColumns(cls, layerID, nLayers, columns):
+        layerID = np.asarray(layerID, dtype=np.int64)
+        order = np.argsort(layerID, kind='mergesort')
+        layerID = layerID[order]
+        offsets = np.searchsorted(layerID, np.arange(nLayers + 1))
+        dtypes = dict((name, dtype) for name, method, dtype in cls.inputs)
+        dtypes.update((name, dtype) for name, dtype, value in cls.outputs)
+        return cls(layerID, offsets, dict((name, np.asarray(values, dtype=dtypes[name])[order]) for name, values in columns.items()))
+
+    def __len__(self):
+        return len(self.layerID)
+
+    # store of the hits lo to hi, its arrays are views so the clustering results are written to this store
+    def slice(self, lo, hi):
+        return HitStore(self.layerID[lo:hi], np.clip(self.offsets - lo, 0, hi - lo),
+                        dict((name, getattr(self, name)[lo:hi]) for name in self.columns))
+
+    # store of the hits of one layerID
+    def layerHits(self, layerID):
+        return self.slice(self.offsets[layerID], self.offsets[layerID + 1])
+
+    # store of the hits of one event, for the stores of several events (nLayers: number of layerIDs per event)
+    def eventHits(self, event, nLayers):
+        first, last = event * nLayers, (event + 1) * nLayers
+        lo, hi = self.offsets[first], self.offsets[last]
+        return HitStore(self.layerID[lo:hi], self.offsets[first:last + 1] - lo, dict((name, getattr(self, name)[lo:hi]) for name in self.columns))
+
+    # lists of hexel views of the hits of each cluster, in the order of the hits
+    def clusterHexels(self):
+        clusters = [[] for ci in range(0, self.clusterIndex.max() + 1 if len(self) > 0 else 0)]
+        for i, ci in enumerate(self.clusterIndex.tolist()):
+            if(ci != -1):
+                clusters[ci].append(HexelView(self, i))
+        return clusters
+
+    # list of hexel views of the hits (of one layerID, or of all of them)
+    def hexels(self, layerID=None):
+        if layerID is None:
+            return [HexelView(self, i) for i in range(len(self))]
+        return [HexelView(self, i) for i in range(self.offsets[layerID], self.offsets[layerID + 1])]
+
+
+# definition of the view of one hit of a HitStore, with the attributes of Hexel
+class HexelView(object):
+    __slots__ = ('store', 'index')
+    fraction = 1
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __gt__(self, other_rho):
+        return self.rho > other_rho
+
+
+def _hexelViewAttribute(name):
+    def get(self):
+        return getattr(self.store, name)[self.index].item()
+
+    def set(self, value):
+        getattr(self.store, name)[self.index] = value
+    return property(get, set)
+
+
+for _name in HitStore.columns:
+    setattr(HexelView, _name, _hexelViewAttribute(_name))
+
+
+# definition of a table of clusters: one array per attribute, one entry per cluster
+class ClusterTable(object):
+
+    # columns: list of (name, array) pairs, all the arrays have the same length
+    def __init__(self, columns):
+        self.columns = tuple(name for name, values in columns)
+        for name, values in columns:
+            setattr(self, name, values)
+
+    def __len__(self):
+        return len(getattr(self, self.columns[0]))
+
+    # table of some of the clusters (rows: indices or mask)
+    def take(self, rows):
+        return ClusterTable([(name, getattr(self, name)[rows]) for name in self.columns])
+
 # definition of basic cluster (based on a set of sub-clusters or set of hexels)
 
 
@@ -94,6 +209,46 @@ class BasicCluster:
     _usedIn3DClust = 0  # internal
 
 
+# definition of a point in x/y/z, with the accessors of ROOT.Math.XYZPoint (eta and phi computed as in ROOT)
+class Point(object):
+    __slots__ = ('_x', '_y', '_z', '_eta', '_phi')
+
+    def __init__(self, x=0., y=0., z=0., eta=None, phi=None):
+        self._x = x
+        self._y = y
+        self._z = z
+        self._eta = eta
+        self._phi = phi
+
+    def x(self):
+        return self._x
+
+    def y(self):
+        return self._y
+
+    def z(self):
+        return self._z
+
+    def eta(self):
+        if self._eta is None:
+            self._eta = etaPhi([self._x], [self._y], [self._z])[0][0].item()
+        return self._eta
+
+    def phi(self):
+        if self._phi is None:
+            self._phi = etaPhi([self._x], [self._y], [self._z])[1][0].item()
+        return self._phi
+
+    def __eq__(self, other):
+        return (self.x(), self.y(), self.z()) == (other.x(), other.y(), other.z())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Point({}, {}, {})".format(self._x, self._y, self._z)
+
+
 # definition of the HGCalImagingAlgo class's methods & variables
 class HGCalImagingAlgo:
 
@@ -104,7 +259,8 @@ class HGCalImagingAlgo:
     lastLayerFH = 40  # last layer of FH
     maxlayer = 52  # last layer of BH
 
-    def __init__(self, ecut=None, deltac=None, multiclusterRadii=None, minClusters=None, dependSensor=None, verbosityLevel=None):
+    def __init__(self, ecut=None, deltac=None, multiclusterRadii=None, minClusters=None, dependSensor=None, verbosityLevel=None,
+                 executor=None, workers=None):
         # sensor dependance or not
         self.dependSensor = False
         if dependSensor is not None:
@@ -140,6 +296,13 @@ class HGCalImagingAlgo:
         if multiclusterRadii is not None:
             self.multiclusterRadii = multiclusterRadii
 
+        # layers in parallel: None (one after the other), "threads", "processes" or a pool with a map method
+        if executor not in (None, "threads", "processes") and not hasattr(executor, "map"):
+            raise ValueError("Unknown executor {}, expected None, 'threads', 'processes' or a pool".format(executor))
+        self.executor = executor
+        self.workers = workers  # number of threads or processes, all the cores by default
+        self._pool = None
+
         # others
         self.verbosityLevel = 0  # 0 - only basic info (default); 1 - additional info; 2 - detailed info printed
         if verbosityLevel is not None:
@@ -156,204 +319,317 @@ class HGCalImagingAlgo:
             print("   multiclusterRadii: ", self.multiclusterRadii)
             print("   minClusters: ", self.minClusters)
             print("   verbosityLevel: ", self.verbosityLevel)
-
-    # calculate max local density in a 2D plane of hexels
-    def calculateLocalDensity(self, nd, lp, layer):
-        maxdensity = 0
+            print("   executor: ", self.executor)
+
+    # the pool is not sent to the worker processes
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["executor"] = None
+        state["_pool"] = None
+        return state
+
+    # pool of workers running the layers, made at the first use
+    def pool(self):
+        if hasattr(self.executor, "map"):
+            return self.executor
+        if self._pool is None:
+            workers = self.workers
+            if workers is None:
+                workers = multiprocessing.cpu_count()
+            if self.executor == "threads":
+                self._pool = ThreadPool(workers)
+            else:
+                self._pool = multiprocessing.Pool(workers)
+        return self._pool
+
+    # stop the workers made by pool()
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    # critical distance of the 2D clustering in a layer
+    def criticalDistance(self, layer):
         if(layer <= self.lastLayerEE):
             delta_c = self.deltac[0]
         elif(layer <= self.lastLayerFH):
             delta_c = self.deltac[1]
         else:
             delta_c = self.deltac[2]
-        for iNode in nd:
-            # search in a circle of radius delta_c or delta_c*sqrt(2) (not identical to search in the box delta_c)
-            found = lp.query_ball_point([iNode.x, iNode.y], delta_c)
-            for j in found:
-                if(distanceReal2(iNode, nd[j]) < delta_c * delta_c):
-                    iNode.rho += nd[j].weight
-                    if(iNode.rho > maxdensity):
-                        maxdensity = iNode.rho
+        return delta_c
+
+    # calculate max local density in a 2D plane of hexels (nd: HitStore of one layer, lp: its neighbourPairs or None)
+    def calculateLocalDensity(self, nd, lp, layer):
+        maxdensity = 0
+        delta_c = self.criticalDistance(layer)
+        nd.rho += localDensity(nd.x, nd.y, nd.weight, delta_c, pairs=lp)
+        if(len(nd) > 0 and nd.rho.max() > maxdensity):
+            maxdensity = nd.rho.max().item()
         return maxdensity
 
-    # calculate distance to the nearest hit with higher density (still does not use KDTree)
+    # calculate distance to the nearest hit with higher density (nd: HitStore of one layer)
     def calculateDistanceToHigher(self, nd):
-        # sort vector of Hexels by decreasing local density
-        rs = sorted(range(len(nd)), key=lambda k: nd[k].rho, reverse=True)
-
         # intial values, and check if there are any hits
         maxdensity = 0.0
-        nearestHigher = -1
-        if(len(nd) > 0):
-            maxdensity = nd[rs[0]].rho
-        else:
+        if(len(nd) == 0):
             return maxdensity  # there are no hits
-
-        #   start by setting delta for the highest density hit to the most distant hit - this is a convention
-        dist2 = 0.
-        for jNode in nd:
-            tmp = distanceReal2(nd[rs[0]], jNode)
-            if(tmp > dist2):
-                dist2 = tmp
-        nd[rs[0]].delta = pow(dist2, 0.5)
-        nd[rs[0]].nearestHigher = nearestHigher
-
-        # now we save the largest distance as a starting point
-        max_dist2 = dist2
-        # calculate all remaining distances to the nearest higher density
-        for oi in range(1, len(nd)):  # start from second-highest density
-            dist2 = max_dist2
-            # we only need to check up to oi since hits are ordered by decreasing density
-            # and all points coming BEFORE oi are guaranteed to have higher rho and the ones AFTER to have lower rho
-            for oj in range(0, oi):
-                tmp = distanceReal2(nd[rs[oi]], nd[rs[oj]])
-                if(tmp <= dist2):  # this "<=" instead of "<" addresses the (rare) case when there are only two hits
-                    dist2 = tmp
-                    nearestHigher = rs[oj]
-            nd[rs[oi]].delta = pow(dist2, 0.5)
-            nd[rs[oi]].nearestHigher = nearestHigher  # this uses the original unsorted hitlist
-
-        return maxdensity
+        delta, nearestHigher = distanceToHigher(nd.x, nd.y, nd.rho)
+        nd.delta[:] = delta
+        nd.nearestHigher[:] = nearestHigher  # this uses the original unsorted hitlist
+        return nd.rho.max().item()
 
     # find cluster centers that satisfy delta & maxdensity/kappa criteria, and assign coresponding hexels
+    # (nd: HitStore of one layer, lp: its neighbourPairs or None)
     def findAndAssignClusters(self, nd, points_0, points_1, lp, maxdensity, layer, verbosityLevel=None):
+        if lp is None:
+            lp = neighbourPairs(points_0, points_1, self.criticalDistance(layer))
+        self.assignClusters(nd, lp, maxdensity, layer, verbosityLevel)
+        return nd.clusterHexels()
+
+    # set the clusterIndex, isBorder and isHalo of the hits of one layer, returns the number of clusters
+    # (nd: HitStore of one layer, lp: its neighbourPairs)
+    def assignClusters(self, nd, lp, maxdensity, layer, verbosityLevel=None):
 
         # adjust verbosityLevel if necessary
         if verbosityLevel is None:
             verbosityLevel = self.verbosityLevel
-        clusterIndex = 0
-        # sort Hexels by decreasing local density and by decreasing distance to higher
-        rs = sorted(range(len(nd)), key=lambda k: nd[k].rho, reverse=True)  # indices sorted by decreasing rho
-        ds = sorted(range(len(nd)), key=lambda k: nd[k].delta, reverse=True)  # sort in decreasing distance to higher
+        # sort Hexels by decreasing local density and by decreasing distance to higher (stable, as sorted(..., reverse=True))
+        rs = np.argsort(-nd.rho, kind='mergesort')  # indices sorted by decreasing rho
+        ds = np.argsort(-nd.delta, kind='mergesort')  # sort in decreasing distance to higher
 
-        if(layer <= self.lastLayerEE):
-            delta_c = self.deltac[0]
-        elif(layer <= self.lastLayerFH):
-            delta_c = self.deltac[1]
-        else:
-            delta_c = self.deltac[2]
+        delta_c = self.criticalDistance(layer)
 
-        for i in range(0, len(nd)):
-            if(nd[ds[i]].delta < delta_c):
-                break  # no more cluster centers to be looked at
-            # skip this as a potential cluster center because it fails the density cut
-            if(self.dependSensor):
-                if(nd[ds[i]].rho < self.kappa * nd[ds[i]].sigmaNoise):
-                    continue  # set equal to kappa times noise threshold
-            else:
-                if(nd[ds[i]].rho < maxdensity / self.kappa):
-                    continue
-            # store cluster index
-            nd[ds[i]].clusterIndex = clusterIndex
-            if (verbosityLevel >= 2):
-                print("Adding new cluster with index ", clusterIndex)
-                print("Cluster center is hit ", ds[i], " with density rho: ", nd[ds[i]].rho, "and delta: ", nd[ds[i]].delta, "\n")
-            clusterIndex += 1
+        # cluster centers are the hits far enough from any higher density, that pass the density cut
+        ds = ds[nd.delta[ds] >= delta_c]
+        if(self.dependSensor):
+            centers = ds[~(nd.rho[ds] < self.kappa * nd.sigmaNoise[ds])]  # set equal to kappa times noise threshold
+        else:
+            centers = ds[~(nd.rho[ds] < maxdensity / self.kappa)]
+        # store cluster index
+        clusterIndex = len(centers)
+        nd.clusterIndex[centers] = np.arange(clusterIndex)
+        if (verbosityLevel >= 2):
+            for ci, i in enumerate(centers.tolist()):
+                print("Adding new cluster with index ", ci)
+                print("Cluster center is hit ", i, " with density rho: ", nd.rho[i], "and delta: ", nd.delta[i], "\n")
 
         # at this point clusterIndex is equal to the number of cluster centers - if it is zero we are done
         if(clusterIndex == 0):
-            return []
-        current_clusters = [[] for i in range(0, clusterIndex)]
+            return 0
 
         # assign to clusters, using the nearestHigher set from previous step (always set except for top density hit that is skipped)...
-        for oi in range(1, len(nd)):
-            ci = nd[rs[oi]].clusterIndex
-            if(ci == -1):
-                nd[rs[oi]].clusterIndex = nd[nd[rs[oi]].nearestHigher].clusterIndex
+        clusterIndices = nd.clusterIndex.tolist()
+        nearestHigher = nd.nearestHigher.tolist()
+        for i in rs[1:].tolist():
+            if(clusterIndices[i] == -1):
+                clusterIndices[i] = clusterIndices[nearestHigher[i]]
+        nd.clusterIndex[:] = clusterIndices
 
         # assign points closer than dc to other clusters to border region and find critical border density
-        rho_b = [0. for i in range(0, clusterIndex)]
-        lp = spatial.KDTree(list(zip(points_0, points_1)), leafsize=self.leafsize)  # new KDTree
-        # now loop on all hits again :( and check: if there are hits from another cluster within d_c -> flag as border hit
-        for iNode in nd:
-            ci = iNode.clusterIndex
-            flag_isolated = True
-            if(ci != -1):
-                # search in a circle of radius delta_c or delta_c*sqrt(2) (not identical to search in the box delta_c)
-                found = lp.query_ball_point([iNode.x, iNode.y], delta_c)
-                # found = lp.query_ball_point([iNode.x,iNode.y],delta_c*pow(2,0.5))
-                for j in found:
-                    # check if the hit is not within d_c of another cluster
-                    if(nd[j].clusterIndex != -1):
-                        dist2 = distanceReal2(nd[j], iNode)
-                        if(dist2 < delta_c * delta_c and nd[j].clusterIndex != ci):
-                            # in which case we assign it to the border
-                            iNode.isBorder = True
-                            break
-                        # because we are using two different containers, we have to make sure that we don't unflag the
-                        # hit when it finds *itself* closer than delta_c
-                        if(dist2 < delta_c * delta_c and dist2 != 0. and nd[j].clusterIndex == ci):
-                            # this is not an isolated hit
-                            flag_isolated = False
-                if(flag_isolated):
-                    iNode.isBorder = True  # the hit is more than delta_c from any of its brethren
-            # check if this border hit has density larger than the current rho_b and update
-            if(iNode.isBorder and rho_b[ci] < iNode.rho):
-                rho_b[ci] = iNode.rho
-
-        # flag points in cluster with density < rho_b as halo points, then fill the cluster vector
-        for iNode in nd:
-            ci = iNode.clusterIndex
-            if(ci != -1 and iNode.rho <= rho_b[ci]):
-                pass
-                iNode.isHalo = True  # some issues to be debugged?
-            if(ci != -1):
-                current_clusters[ci].append(iNode)
-                if (verbosityLevel >= 2):
-                    print("Pushing hit ", iNode, " into cluster with index ", ci)
-                    print("   rho_b[ci]: ", rho_b[ci], ", iNode.rho: ", iNode.rho, " iNode.isHalo: ", iNode.isHalo)
-
-        return current_clusters
-
-    # make list of Hexels out of rechits
+        first, second = lp  # pairs of hits closer than delta_c
+        firstIndex = nd.clusterIndex[first]
+        secondIndex = nd.clusterIndex[second]
+        dist2 = (nd.x[second] - nd.x[first])**2 + (nd.y[second] - nd.y[first])**2
+        # hits within d_c of another cluster
+        otherCluster = (firstIndex != -1) & (secondIndex != -1) & (secondIndex != firstIndex)
+        # hits within d_c of their brethren (and not only of *themselves*, or of hits at the same position)
+        brethren = (firstIndex != -1) & (secondIndex == firstIndex) & (dist2 != 0.)
+        # border hits are within d_c of another cluster, or more than delta_c from any of their brethren
+        isBorder = (np.bincount(first[otherCluster], minlength=len(nd)) > 0) | (np.bincount(first[brethren], minlength=len(nd)) == 0)
+        nd.isBorder |= isBorder & (nd.clusterIndex != -1)
+        # highest density of the border hits of each cluster
+        rho_b = np.zeros(clusterIndex, dtype=np.float64)
+        np.maximum.at(rho_b, nd.clusterIndex[nd.isBorder], nd.rho[nd.isBorder])
+
+        # flag points in cluster with density < rho_b as halo points
+        clustered = nd.clusterIndex != -1
+        nd.isHalo[clustered] |= nd.rho[clustered] <= rho_b[nd.clusterIndex[clustered]]
+        if (verbosityLevel >= 2):
+            for i in np.flatnonzero(clustered).tolist():
+                ci = clusterIndices[i]
+                print("Pushing hit ", i, " into cluster with index ", ci)
+                print("   rho_b[ci]: ", rho_b[ci], ", iNode.rho: ", nd.rho[i], " iNode.isHalo: ", nd.isHalo[i])
+
+        return clusterIndex
+
+    # make the store of hexels out of rechits (the hexels of a layer keep the order of the rechits)
     def populate(self, rHitsCollection, ecut=None):
-        # adjust ecut if necessary
-        if ecut is None:
-            ecut = self.ecut
-        # init 2D hexels
-        points = [[] for i in range(0, 2 * (self.maxlayer + 1))]  # initialise list of per-layer-lists of hexels
-
-        # loop over all hits and create the Hexel structure, skip energies below ecut
-        for rHit in rHitsCollection:
-            if (rHit.layer() > self.maxlayer):
-                continue  # current protection
-            # energy treshold dependent on sensor
-            sigmaNoise, aboveThreshold = recHitAboveThreshold(rHit, ecut=ecut, dependSensor=self.dependSensor)
-            if not aboveThreshold:
-                continue
-            # organise layers accoring to the sgn(z)
-            layerID = rHit.layer() + (rHit.z() > 0) * (self.maxlayer + 1)  # +1 - yes or no?
-            points[layerID].append(Hexel(rHit, sigmaNoise))
-
-        return points
+        return self.populateColumns(recHitColumns(rHitsCollection, [method for name, method, dtype in HitStore.inputs]), ecut=ecut)
 
-    # make 2D clusters out of rechists (need to introduce class with input params: delta_c, kappa, ecut, ...)
-    def makeClusters(self, rHitsCollection, ecut=None):
+    # make the store of hexels out of rechit columns (keyed by rechit method), of one event or of several ones (events:
+    # event of each rechit, nEvents: number of events), then the hits are ordered by event and layerID
+    def populateColumns(self, columns, ecut=None, events=None, nEvents=1):
         # adjust ecut if necessary
         if ecut is None:
             ecut = self.ecut
-        # init 2D cluster lists
-        clusters = [[] for i in range(0, 2 * (self.maxlayer + 1))]  # initialise list of per-layer-clusters
+        # skip energies below ecut (energy treshold dependent on sensor)
+        columns = dict((method, np.asarray(columns[method])) for name, method, dtype in HitStore.inputs)
+        selected = np.flatnonzero(columns["layer"] <= self.maxlayer)  # current protection
+        sigmaNoise, above = aboveThreshold(columns["layer"][selected], columns["thickness"][selected],
+                                           columns["energy"][selected], ecut=ecut, dependSensor=self.dependSensor)
+        selected = selected[above]
+        columns = dict((name, columns[method][selected]) for name, method, dtype in HitStore.inputs)
+        columns["sigmaNoise"] = sigmaNoise[above]
+        # organise layers accoring to the sgn(z)
+        layerIDs = columns["layer"] + (columns["z"] > 0) * (self.maxlayer + 1)  # +1 - yes or no?
+        if events is None:
+            return HitStore.fromColumns(layerIDs, 2 * (self.maxlayer + 1), columns)
+
+        # and the events one after the other, with the offsets of the (event, layerID) segments
+        hits = HitStore.fromColumns(np.asarray(events)[selected] * 2 * (self.maxlayer + 1) + layerIDs, nEvents * 2 * (self.maxlayer + 1), columns)
+        hits.layerID %= 2 * (self.maxlayer + 1)
+        return hits
+
+    # make 2D clusters of one layer (points: HitStore of the layer), the results are written to the store
+    def makeLayerClusters(self, points, layerID):
+        layer = layerID - int(points.z[0] > 0) * (self.maxlayer + 1)  # map back to actual layer
+        lp = neighbourPairs(points.x, points.y, self.criticalDistance(layer))  # used for the density and the border hits
+        maxdensity = self.calculateLocalDensity(points, lp, layer)  # get the max density
+        # print "layer: ", layer, ", max density: ", maxdensity, ", total hits: ", len(points)
+        self.calculateDistanceToHigher(points)  # get distances to the nearest higher density
+        self.assignClusters(points, lp, maxdensity, layer)  # get clusters per layer
 
-        # get the list of Hexels out of raw rechits
-        points = self.populate(rHitsCollection, ecut=ecut)
-
-        # loop over all layers, and for each layer create a list of clusters. layers are organised according to the sgn(z)
-        for layerID in range(0, 2 * (self.maxlayer + 1)):
-            if (len(points[layerID]) == 0):
-                continue  # protection
-            layer = layerID - (points[layerID][0].z > 0) * (self.maxlayer + 1)  # map back to actual layer
-            points_0 = [hex.x for hex in points[layerID]]  # list of hexels'coordinate 0 for current layer
-            points_1 = [hex.y for hex in points[layerID]]  # list of hexels'coordinate 1 for current layer
-            hit_kdtree = spatial.KDTree(list(zip(points_0, points_1)), leafsize=self.leafsize)  # create KDTree
-            maxdensity = self.calculateLocalDensity(points[layerID], hit_kdtree, layer)  # get the max density
-            # print "layer: ", layer, ", max density: ", maxdensity, ", total hits: ", len(points[layer])
-            self.calculateDistanceToHigher(points[layerID])  # get distances to the nearest higher density
-            clusters[layerID] = self.findAndAssignClusters(points[layerID], points_0, points_1, hit_kdtree, maxdensity, layer)  # get clusters per layer
+    # make 2D clusters out of rechists (need to introduce class with input params: delta_c, kappa, ecut, ...)
+    # flat: return the HitStore (per-hit layerID, clusterIndex, isHalo, rho, delta, ...) and its clusterTable instead
+    # of the per-layer lists of clusters, without making any hexel or cluster object
+    def makeClusters(self, rHitsCollection, ecut=None, flat=False):
+        # get the store of hexels out of raw rechits, and cluster it
+        hits = self.populate(rHitsCollection, ecut=ecut)
+        self.clusterHits(hits)
+        if flat:
+            return hits, self.clusterTable(hits)
 
         # return the clusters list
+        clusters = [[] for i in range(0, 2 * (self.maxlayer + 1))]  # initialise list of per-layer-clusters
+        for layerID in range(0, 2 * (self.maxlayer + 1)):
+            if hits.offsets[layerID + 1] > hits.offsets[layerID]:
+                clusters[layerID] = hits.layerHits(layerID).clusterHexels()
         return clusters
 
+    # make 2D clusters out of the rechits of several events at once
+    # batch: EventChunk of NtupleDataFormat with the rechit prefix, or dictionary of the rechit columns of all the
+    # events concatenated (keyed by rechit method), offsets: first rechit of each event (and the end) for the latter.
+    # All the (event, layerID) segments are clustered together (see clusterSegments, or one by one in the executor, if
+    # any), and the result is given as for makeClusters(..., flat=True): the HitStore of all the events, ordered by
+    # event then layerID (its offsets are the ones of the (event, layerID) segments, see eventHits), and their
+    # clusterTable ordered by event.
+    def clusterEvents(self, batch, offsets=None, ecut=None):
+        if offsets is None:
+            batch, offsets = batch.columns("rechit"), batch.offsets("rechit")
+        offsets = np.asarray(offsets, dtype=np.int64)
+        events = np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+        hits = self.populateColumns(batch, ecut=ecut, events=events, nEvents=len(offsets) - 1)
+        self.clusterHits(hits)
+        return hits, self.clusterTable(hits)
+
+    # cluster a store of hexels, each (event, layerID) segment (each layerID for the stores of one event) separately
+    def clusterHits(self, hits):
+        # all the segments at once, unless they are sent to the executor or printed one after the other
+        if self.executor is None and self.verbosityLevel < 2:
+            self.clusterSegments(hits)
+            return
+
+        nLayerIDs = 2 * (self.maxlayer + 1)
+        # layers are organised according to the sgn(z), skip the ones without hits
+        segments = [segment for segment in range(0, len(hits.offsets) - 1) if hits.offsets[segment + 1] > hits.offsets[segment]]
+
+        # loop over all layers, and for each layer create the clusters
+        if self.executor is None:
+            for segment in segments:
+                self.makeLayerClusters(hits.layerHits(segment), segment % nLayerIDs)
+            return
+
+        # or run them in parallel, the most populated first so that they do not end up last, and merge by layerID
+        segments.sort(key=lambda segment: hits.offsets[segment] - hits.offsets[segment + 1])
+        tasks = [(self, segment % nLayerIDs, hits.layerHits(segment)) for segment in segments]
+        for segment, outputs in zip(segments, self.pool().map(_makeLayerClusters, tasks, chunksize=1)):
+            points = hits.layerHits(segment)
+            for (name, dtype, value), values in zip(HitStore.outputs, outputs):
+                getattr(points, name)[:] = values  # copy back what the worker processes computed
+
+    # cluster all the (event, layerID) segments of a store together, with the same results as makeLayerClusters on
+    # each of them: the neighbour search, the densities, the distances to higher and the assignment to the clusters
+    # are done over all the hits, keyed by their segment
+    def clusterSegments(self, hits):
+        n = len(hits)
+        if(n == 0):
+            return
+        nSegments = len(hits.offsets) - 1
+        segments = np.repeat(np.arange(nSegments, dtype=np.int64), np.diff(hits.offsets))
+        delta_c = np.where(hits.layer <= self.lastLayerEE, self.deltac[0],
+                           np.where(hits.layer <= self.lastLayerFH, self.deltac[1], self.deltac[2])).astype(np.float64)
+
+        # local density, and the max one of each segment
+        lp = neighbourPairs(hits.x, hits.y, delta_c, segments)  # used for the density and the border hits
+        hits.rho += localDensity(hits.x, hits.y, hits.weight, delta_c, pairs=lp)
+        maxdensity = np.zeros(nSegments, dtype=np.float64)
+        np.maximum.at(maxdensity, segments, hits.rho)
+
+        # distance to the nearest hit with higher density (the store keeps its index within the segment)
+        delta, nearestHigher = distanceToHigher(hits.x, hits.y, hits.rho, segments)
+        hits.delta[:] = delta
+        nearestHigher = np.array(nearestHigher, dtype=np.int64)
+        hits.nearestHigher[:] = np.where(nearestHigher != -1, nearestHigher - hits.offsets[segments], -1)
+
+        # cluster centers, by segment and decreasing distance to higher (stable, as in assignClusters)
+        ds = np.lexsort((-hits.delta, segments))
+        ds = ds[hits.delta[ds] >= delta_c[ds]]
+        if(self.dependSensor):
+            centers = ds[~(hits.rho[ds] < self.kappa * hits.sigmaNoise[ds])]
+        else:
+            centers = ds[~(hits.rho[ds] < maxdensity[segments[ds]] / self.kappa)]
+        labels = np.full(n, -1, dtype=np.int64)
+        labels[centers] = np.arange(len(centers))
+
+        # assign to the cluster of the nearest higher, following the nearestHigher up to a center or to the top density hit
+        parent = np.where((labels == -1) & (nearestHigher != -1), nearestHigher, np.arange(n))
+        grandParent = parent[parent]
+        while(np.any(grandParent != parent)):
+            parent, grandParent = grandParent, grandParent[grandParent]
+        labels = labels[parent]
+        clustered = labels != -1
+        firstLabel = np.searchsorted(segments[centers], np.arange(nSegments))
+        hits.clusterIndex[clustered] = labels[clustered] - firstLabel[segments[clustered]]
+
+        # border and halo hits, as in assignClusters (the labels differ between the clusters of a segment as the clusterIndex)
+        first, second = lp
+        firstIndex = labels[first]
+        secondIndex = labels[second]
+        dist2 = (hits.x[second] - hits.x[first])**2 + (hits.y[second] - hits.y[first])**2
+        otherCluster = (firstIndex != -1) & (secondIndex != -1) & (secondIndex != firstIndex)
+        brethren = (firstIndex != -1) & (secondIndex == firstIndex) & (dist2 != 0.)
+        isBorder = (np.bincount(first[otherCluster], minlength=n) > 0) | (np.bincount(first[brethren], minlength=n) == 0)
+        hits.isBorder |= isBorder & clustered
+        rho_b = np.zeros(len(centers), dtype=np.float64)
+        np.maximum.at(rho_b, labels[hits.isBorder], hits.rho[hits.isBorder])
+        hits.isHalo[clustered] |= hits.rho[clustered] <= rho_b[labels[clustered]]
+
+    # table of the 2D clusters of a HitStore clustered by makeClusters or clusterEvents, ordered by event, layerID and
+    # clusterIndex (the columns layerID and clusterIndex match the ones of the hits). The clusters whose position could
+    # not be computed are not in the table, as in getClusters
+    def clusterTable(self, hits):
+        nLayerIDs = 2 * (self.maxlayer + 1)
+        nSegments = len(hits.offsets) - 1  # (event, layerID) segments, nLayerIDs for the stores of one event
+        clustered = np.flatnonzero(hits.clusterIndex != -1)
+        segments = np.repeat(np.arange(nSegments, dtype=np.int64), np.diff(hits.offsets))[clustered]
+        # number of clusters of each segment, and the label of the first of them
+        nClusters = np.zeros(nSegments, dtype=np.int64)
+        np.maximum.at(nClusters, segments, hits.clusterIndex[clustered] + 1)
+        firstLabel = np.concatenate(([0], np.cumsum(nClusters)))
+        labels = firstLabel[segments] + hits.clusterIndex[clustered]
+        x, y, z, energy = clusterPositionsByLabel(labels, firstLabel[-1], hits.weight[clustered], hits.x[clustered],
+                                                  hits.y[clustered], hits.z[clustered], hits.isHalo[clustered])
+        eta, phi = etaPhi(x, y, z)
+        segment = np.repeat(np.arange(nSegments, dtype=np.int64), nClusters)
+        layerID = segment % nLayerIDs
+        table = ClusterTable([("event", segment // nLayerIDs), ("layerID", layerID),
+                              ("clusterIndex", np.arange(firstLabel[-1], dtype=np.int64) - firstLabel[segment]),
+                              ("layer", layerID % (self.maxlayer + 1)), ("energy", energy), ("x", x), ("y", y), ("z", z),
+                              ("eta", eta), ("phi", phi), ("nHits", np.bincount(labels, minlength=firstLabel[-1]))])
+        # skip the clusters where position could not be computed (either all weights are 0, or all hexels are tagged as Halo)
+        return table.take(~((x == 0.) & (y == 0.) & (z == 0.)))
+
     # get basic clusters from the list of 2D clusters
     def getClusters(self, clusters, verbosityLevel=None):
         # adjust verbosityLevel if necessary
@@ -361,32 +637,48 @@ class HGCalImagingAlgo:
             verbosityLevel = self.verbosityLevel
         # init the list
         clusters_v = []
-        # loop over all layers and all clusters in each layer
+        # loop over all layers, the positions and energies of all the clusters of a layer are computed at once
         layer = 0
         for clist_per_layer in clusters:
+            if (len(clist_per_layer) == 0):
+                layer += 1
+                continue
+            x, y, z, energy = clusterPositions(clist_per_layer)
+            eta, phi = etaPhi(x, y, z)
+            x, y, z, energy, eta, phi = x.tolist(), y.tolist(), z.tolist(), energy.tolist(), eta.tolist(), phi.tolist()
             index = 0
-            for cluster in clist_per_layer:
-                position = calculatePosition(cluster)
-                if (position == ROOT.Math.XYZPoint()):
+            for i, cluster in enumerate(clist_per_layer):
+                if (x[i] == 0. and y[i] == 0. and z[i] == 0.):
                     continue  # skip the clusters where position could not be computed (either all weights are 0, or all hexels are tagged as Halo)
-                energy = 0
-                for iNode in cluster:
-                    if (not iNode.isHalo):
-                        energy += iNode.weight
+                position = Point(x[i], y[i], z[i], eta[i], phi[i])
                 if (verbosityLevel >= 1):
                     layerActual = layer - (cluster[0].z > 0) * (self.maxlayer + 1)
                     print("LayerID: ", layer, "Actual layer: ", layerActual, "| 2D-cluster index: ", index, ", No. of cells = ", len(cluster),
-                          ", Energy  = ", energy, ", Phi = ", position.phi(), ", Eta = ", position.eta(), ", z = ", position.z())
-                    for iNode in cluster:
-                        if (not iNode.isHalo):
-                            pass
-                clusters_v.append(BasicCluster(energy=energy, position=position, thisCluster=cluster))
+                          ", Energy  = ", energy[i], ", Phi = ", position.phi(), ", Eta = ", position.eta(), ", z = ", position.z())
+                clusters_v.append(BasicCluster(energy=energy[i], position=position, thisCluster=cluster))
                 index += 1
             layer += 1
-            clusters_v.sort(key=getEnergy, reverse=True)
+        clusters_v.sort(key=getEnergy, reverse=True)
         return clusters_v
 
-    # make multi-clusters starting from the 2D clusters, without KDTree
+    # make the multi-clusters (basic clusters) out of lists of 2D clusters, their positions and energies are computed at once
+    def makeMultiClusters(self, multiClusters, verbosityLevel=None):
+        # adjust verbosityLevel if necessary
+        if verbosityLevel is None:
+            verbosityLevel = self.verbosityLevel
+        thePreClusters = []
+        x, y, z, energy = multiClusterPositions(multiClusters)
+        eta, phi = etaPhi(x, y, z)
+        x, y, z, energy, eta, phi = x.tolist(), y.tolist(), z.tolist(), energy.tolist(), eta.tolist(), phi.tolist()
+        for index, temp in enumerate(multiClusters):
+            position = Point(x[index], y[index], z[index], eta[index], phi[index])
+            thePreClusters.append(BasicCluster(energy=energy[index], position=position, thisCluster=temp))
+            if (verbosityLevel >= 1):
+                print("Multi-cluster index: ", index, ", No. of 2D-clusters = ", len(temp), ", Energy  = ",
+                      energy[index], ", Phi = ", position.phi(), ", Eta = ", position.eta(), ", z = ", position.z())
+        return thePreClusters
+
+    # make multi-clusters starting from the 2D clusters, with a KDTree of all of them
     def makePreClusters(self, clusters, multiclusterRadii=None, minClusters=None, verbosityLevel=None):
         # adjust multiclusterRadii, minClusters and/or verbosityLevel if necessary
         if multiclusterRadii is None:
@@ -399,13 +691,30 @@ class HGCalImagingAlgo:
         thecls = self.getClusters(clusters)
 
         # init lists and vars
-        thePreClusters = []
         vused = [0.] * len(thecls)
-        used = 0
         # indices sorted by decreasing energy
         es = sorted(range(len(thecls)), key=lambda k: thecls[k].energy, reverse=True)
+        # squared radius of each cluster, according to its layer
+        radius2 = []
+        for k in es:
+            layer = thecls[k].thisCluster[0].layer
+            multiclusterRadius = 9999.
+            multiclusterRadius = multiclusterRadii[0]
+            if(layer > self.lastLayerEE and layer <= self.lastLayerFH):
+                multiclusterRadius = multiclusterRadii[1]
+            else:
+                multiclusterRadius = multiclusterRadii[2]
+            radius2.append(multiclusterRadius * multiclusterRadius)
+        # KDTree of the clusters in decreasing energy, repeated at phi -/+ 2pi for the eta/phi distance
+        if(self.realSpaceCone):
+            coordinates = [[thecls[k].x, thecls[k].y] for k in es]
+        else:
+            coordinates = [[thecls[k].eta, thecls[k].phi + shift] for shift in (0., -2 * math.pi, 2 * math.pi) for k in es]
+        if(len(thecls) > 0):
+            cls_kdtree = spatial.cKDTree(np.array(coordinates, dtype=np.float64))
+        searchRadius = max(multiclusterRadii) * (1. + 1e-9)  # the distances are checked again below
         # loop over all clusters
-        index = 0
+        multiClusters = []
         for i in range(0, len(thecls)):
             if(vused[i] == 0):
                 temp = [thecls[es[i]]]
@@ -413,36 +722,25 @@ class HGCalImagingAlgo:
                     vused[i] = 1
                 else:
                     vused[i] = -1
-                used += 1
-                for j in range(i + 1, len(thecls)):
-                    if(vused[j] == 0):
+                found = cls_kdtree.query_ball_point(coordinates[i], searchRadius)
+                for j in sorted(set(k % len(thecls) for k in found)):
+                    if(j > i and vused[j] == 0):
                         distanceCheck = 9999.
                         if(self.realSpaceCone):
                             distanceCheck = distanceReal2(thecls[es[i]], thecls[es[j]])
                         else:
                             distanceCheck = distanceDR2(thecls[es[i]], thecls[es[j]])
-                        layer = thecls[es[j]].thisCluster[0].layer
-                        multiclusterRadius = 9999.
-                        multiclusterRadius = multiclusterRadii[0]
-                        if(layer > self.lastLayerEE and layer <= self.lastLayerFH):
-                            multiclusterRadius = multiclusterRadii[1]
-                        else:
-                            multiclusterRadius = multiclusterRadii[2]
-                        if(distanceCheck < multiclusterRadius * multiclusterRadius and int(thecls[es[i]].z * vused[i]) > 0):
+                        if(distanceCheck < radius2[j] and int(thecls[es[i]].z * vused[i]) > 0):
                             temp.append(thecls[es[j]])
                             vused[j] = vused[i]
-                            used += 1
                 if(len(temp) > minClusters):
-                    position = getMultiClusterPosition(temp)
-                    energy = getMultiClusterEnergy(temp)
-                    thePreClusters.append(BasicCluster(energy=energy, position=position, thisCluster=temp))
-                    if (verbosityLevel >= 1):
-                        print("Multi-cluster index: ", index, ", No. of 2D-clusters = ", len(temp), ", Energy  = ",
-                              energy, ", Phi = ", position.phi(), ", Eta = ", position.eta(), ", z = ", position.z())
-                    index += 1
-        return thePreClusters
+                    multiClusters.append(temp)
+        return self.makeMultiClusters(multiClusters, verbosityLevel)
 
-    # make multi-clusters starting from the 2D clusters, with KDTree
+    # make multi-clusters starting from the 2D clusters, with KDTree (one per layer). The 2D clusters are either the
+    # per-layer lists of makeClusters, or the ClusterTable of makeClusters(..., flat=True) or clusterEvents: then the
+    # multi-clusters are returned as a ClusterTable too, ordered by event, with the index of the multi-cluster of each
+    # 2D cluster (see multiClusterTable)
     def make3DClusters(self, clusters, multiclusterRadii=None, minClusters=None, verbosityLevel=None):
         # adjust multiclusterRadii, minClusters and/or verbosityLevel if necessary
         if multiclusterRadii is None:
@@ -451,82 +749,225 @@ class HGCalImagingAlgo:
             minClusters = self.minClusters
         if verbosityLevel is None:
             verbosityLevel = self.verbosityLevel
+        if isinstance(clusters, ClusterTable):
+            # rows sorted by decreasing energy, in the order of getClusters
+            es = np.argsort(-clusters.energy, kind='mergesort')
+            layerIDs = clusters.layer[es] + (clusters.z[es] > 0) * (self.maxlayer + 1)
+            multiClusters, vused = self.multiClusterIndices(clusters.x[es], clusters.y[es], clusters.z[es], layerIDs, multiclusterRadii,
+                                                            clusters.event[es])
+            multiClusters = [es[temp] for temp in multiClusters if len(temp) > minClusters]
+            multiClusters.sort(key=lambda temp: clusters.event[temp[0]])  # the events do not mix, keep their order
+            return multiClusterTable(clusters, multiClusters)
+
         # get clusters in one list (just following original approach)
         thecls = self.getClusters(clusters)
-
-        # init "points" of 2D clusters for KDTree serach and zees of layers (check if it is really needed)
-        points = [[] for i in range(0, 2 * (self.maxlayer + 1))]  # initialise list of per-layer-lists of clusters
-        zees = [0. for layer in range(0, 2 * (self.maxlayer + 1))]
-        for cls in thecls:  # organise layers accoring to the sgn(z)
-            layerID = cls.thisCluster[0].layer
-            layerID += (cls.z > 0) * (self.maxlayer + 1)  # +1 - yes or no?
-            points[layerID].append(cls)
-            zees[layerID] = cls.z
-
-        # init lists and vars
-        thePreClusters = []
-        vused = [0.] * len(thecls)
-        used = 0
-
         # indices sorted by decreasing energy
         es = sorted(range(len(thecls)), key=lambda k: thecls[k].energy, reverse=True)
+        xs, ys, zs = [np.array([getattr(thecls[k], name) for k in es], dtype=np.float64) for name in ("x", "y", "z")]
+        layerIDs = [thecls[k].thisCluster[0].layer + (thecls[k].z > 0) * (self.maxlayer + 1) for k in es]  # +1 - yes or no?
+        multiClusters, vused = self.multiClusterIndices(xs, ys, zs, layerIDs, multiclusterRadii)
+        for k, used in zip(es, vused):
+            thecls[k]._usedIn3DClust = used
+        return self.makeMultiClusters([[thecls[es[i]] for i in temp] for temp in multiClusters if len(temp) > minClusters], verbosityLevel)
+
+    # multi-clusters of 2D clusters given as x, y, z arrays and layerIDs in decreasing energy (and their events, if
+    # several): the lists of the indices of their 2D clusters (the seed first), and the _usedIn3DClust of each 2D
+    # cluster (the sgn(z) of its seed). The clusters of different events are never merged
+    def multiClusterIndices(self, xs, ys, zs, layerIDs, multiclusterRadii, events=None):
+        nLayerIDs = 2 * (self.maxlayer + 1)
+        events = np.zeros(len(xs), dtype=np.int64) if events is None else np.asarray(events, dtype=np.int64)
+        nEvents = events.max().item() + 1 if len(events) > 0 else 0
+        # init "points" of 2D clusters for KDTree serach and zees of layers (check if it is really needed)
+        points = [[] for i in range(0, nEvents * nLayerIDs)]  # initialise list of per-(event, layer)-lists of clusters
+        zees = [0. for layer in range(0, nEvents * nLayerIDs)]
+        xList, yList, zList = xs.tolist(), ys.tolist(), zs.tolist()
+        for k, segment in enumerate((events * nLayerIDs + np.asarray(layerIDs, dtype=np.int64)).tolist()):  # layers organised accoring to the sgn(z)
+            points[segment].append(k)
+            zees[segment] = zList[k]
+        # clusters of each event and side, in increasing order
+        groups = events * 2 + (zs > 0)
+        order = np.argsort(groups, kind='mergesort')
+        sides = np.split(order, np.searchsorted(groups[order], np.arange(1, 2 * nEvents)))
+
+        # per-layer KDTrees built once, and projections of all the clusters to the layers of their side searched at once
+        projections = [[] for k in xList]  # for each cluster: (segment, x, y, radius, clusters found) in increasing layerID
+        for j in range(0, nEvents * nLayerIDs):
+            if(zees[j] == 0.):
+                continue
+            layer = j % nLayerIDs - (zees[j] > 0) * (self.maxlayer + 1)  # maps back from index used for KD trees to actual layer
+            multiclusterRadius = 9999.
+            if(layer <= self.lastLayerEE):
+                multiclusterRadius = multiclusterRadii[0]
+            elif(layer <= self.lastLayerFH):
+                multiclusterRadius = multiclusterRadii[1]
+            elif(layer <= self.maxlayer):
+                multiclusterRadius = multiclusterRadii[2]
+            else:
+                print("ERROR: Nonsense layer value - cannot assign multicluster radius")
+            side = sides[2 * (j // nLayerIDs) + int(j % nLayerIDs > self.maxlayer)]  # clusters searching in this layer
+            to_0 = (xs[side] / zs[side]) * zees[j]
+            to_1 = (ys[side] / zs[side]) * zees[j]
+            # KD-tree search in layer j
+            hit_kdtree = spatial.cKDTree(np.column_stack((xs[points[j]], ys[points[j]])))  # create KDTree
+            found = hit_kdtree.query_ball_point(np.column_stack((to_0, to_1)), multiclusterRadius)
+            for i, to0, to1, iFound in zip(side.tolist(), to_0.tolist(), to_1.tolist(), found):
+                projections[i].append((j, to0, to1, multiclusterRadius, sorted(iFound)))
+
         # loop over all clusters
-        index = 0
-        for i in range(0, len(thecls)):
-            # if(vused[i]==0):
-            if (thecls[es[i]]._usedIn3DClust == 0):
-                temp = [thecls[es[i]]]
-                if (thecls[es[i]].z > 0):
-                    thecls[es[i]]._usedIn3DClust = 1
+        vused = [0] * len(xList)
+        multiClusters = []
+        for i in range(0, len(xList)):
+            if(vused[i] == 0):
+                temp = [i]
+                if (zList[i] > 0):
+                    vused[i] = 1
                 else:
-                    thecls[es[i]]._usedIn3DClust = -1
-                used += 1
-                from_ = [thecls[es[i]].x, thecls[es[i]].y, thecls[es[i]].z]
-                firstlayer = (thecls[es[i]].z > 0) * (self.maxlayer + 1)
-                lastlayer = firstlayer + self.maxlayer + 1
-                for j in range(firstlayer, lastlayer):
-                    if(zees[j] == 0.):
-                        continue
-                    to_ = [0., 0., zees[j]]
-                    to_[0] = (from_[0] / from_[2]) * to_[2]
-                    to_[1] = (from_[1] / from_[2]) * to_[2]
-                    layer = j - (zees[j] > 0) * (self.maxlayer + 1)  # maps back from index used for KD trees to actual layer
-                    multiclusterRadius = 9999.
-                    if(layer <= self.lastLayerEE):
-                        multiclusterRadius = multiclusterRadii[0]
-                    elif(layer <= self.lastLayerFH):
-                        multiclusterRadius = multiclusterRadii[1]
-                    elif(layer <= self.maxlayer):
-                        multiclusterRadius = multiclusterRadii[2]
-                    else:
-                        print("ERROR: Nonsense layer value - cannot assign multicluster radius")
-                    # KD-tree search in layer j
-                    points_0 = [cls.x for cls in points[j]]  # list of cls' coordinate 0 for layer j
-                    points_1 = [cls.y for cls in points[j]]  # list of cls' coordinate 1 for layer j
-                    hit_kdtree = spatial.KDTree(list(zip(points_0, points_1)), leafsize=self.leafsize)  # create KDTree
-                    found = hit_kdtree.query_ball_point([to_[0], to_[1]], multiclusterRadius)
+                    vused[i] = -1
+                # claim the free clusters found around the projections of this one
+                for j, to0, to1, multiclusterRadius, found in projections[i]:
                     for k in found:
-                        h_to = Hexel()
-                        h_to.x = to_[0]
-                        h_to.y = to_[1]  # dummy object
-                        if((points[j][k]._usedIn3DClust == 0) and (distanceReal2(points[j][k], h_to) < multiclusterRadius**2)):
-                            temp.append(points[j][k])
-                            points[j][k]._usedIn3DClust = thecls[es[i]]._usedIn3DClust
-                            used += 1
-                if(len(temp) > minClusters):
-                    position = getMultiClusterPosition(temp)
-                    energy = getMultiClusterEnergy(temp)
-                    thePreClusters.append(BasicCluster(energy=energy, position=position, thisCluster=temp))
-                    if (verbosityLevel >= 1):
-                        print ("Multi-cluster index: ", index, ", No. of 2D-clusters = ", len(temp), ", Energy  = ",
-                               energy, ", Phi = ", position.phi(), ", Eta = ", position.eta(), ", z = ", position.z())
-                    index += 1
-        return thePreClusters
-
+                        k = points[j][k]
+                        if((vused[k] == 0) and (pow(to0 - xList[k], 2) + pow(to1 - yList[k], 2) < multiclusterRadius**2)):
+                            temp.append(k)
+                            vused[k] = vused[i]
+                multiClusters.append(temp)
+        return multiClusters, vused
+
+
+# 2D clusters of one layer in a worker of HGCalImagingAlgo.pool(), returns the columns set by the clustering
+def _makeLayerClusters(args):
+    algo, layerID, points = args
+    algo.makeLayerClusters(points, layerID)
+    return [getattr(points, name) for name, dtype, value in HitStore.outputs]
+
+
+# all the (i, j) pairs of points closer than delta_c (a number, or one per point), including the (i, i) ones, sorted
+# by i then j. With segments (segment of each point), only the pairs of points of the same segment are given
+def neighbourPairs(x, y, delta_c, segments=None):
+    if(len(x) == 0):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    delta_c = np.broadcast_to(np.asarray(delta_c, dtype=np.float64), np.shape(x))
+    # search in a circle of radius delta_c (not identical to search in the box delta_c), the distances are checked again below
+    radius = delta_c.max() * (1. + 1e-9)
+    points = np.column_stack((x, y) if segments is None else (x, y, _segmentCoordinate(x, y, radius, segments)))
+    pairs = spatial.cKDTree(points).query_pairs(radius, output_type='ndarray')
+    # keep the strict "distance < delta_c" of distanceReal2, computed in the same way
+    dist2 = (x[pairs[:, 1]] - x[pairs[:, 0]])**2 + (y[pairs[:, 1]] - y[pairs[:, 0]])**2
+    pairs = pairs[dist2 < delta_c[pairs[:, 0]] * delta_c[pairs[:, 0]]]
+    self_ = np.arange(len(x), dtype=np.int64)
+    first = np.concatenate((pairs[:, 0], pairs[:, 1], self_))
+    second = np.concatenate((pairs[:, 1], pairs[:, 0], self_))
+    order = np.lexsort((second, first))
+    return first[order], second[order]
+
+
+# third coordinate of points of several segments, that puts the segments further from each other than the extent of
+# any of them and the distance searched (for KDTrees over all the segments)
+def _segmentCoordinate(x, y, distance, segments):
+    span = max(x.max() - x.min(), y.max() - y.min()) + distance
+    return np.asarray(segments, dtype=np.float64) * (2. * span + 1.)
+
+
+# local density of each point: sum of the weights of the points (itself included) closer than delta_c
+def localDensity(x, y, weight, delta_c, pairs=None):
+    if pairs is None:
+        pairs = neighbourPairs(x, y, delta_c)
+    first, second = pairs
+    # the weights are summed in increasing order of the neighbours, as the query_ball_point loop did
+    return np.bincount(first, weights=weight[second], minlength=len(x))
+
+
+# distance to the nearest hit with higher density and its index, for each hit:
+# hits are ordered by decreasing density (the first one in the list on ties) and for each of them the closest
+# of the preceding hits is taken (the last one in this order on ties, as the "<=" of the original double loop).
+# The first hit gets the distance to the most distant hit and -1 - this is a convention.
+# With segments (segment of each hit), this is done for the hits of each segment separately.
+# The candidates are searched among the k nearest neighbours with increasing k, then by brute force, and the
+# closest ones are compared again with the arithmetic of distanceReal2 so that the results do not change.
+def distanceToHigher(x, y, rho, segments=None, k=(8, 64), tolerance=1e-9):
+    n = len(x)
+    delta = [0.] * n
+    nearestHigher = [-1] * n
+    if(n == 0):
+        return delta, nearestHigher
+    if segments is None:
+        segments = np.zeros(n, dtype=np.int64)
+    xList = x.tolist()
+    yList = y.tolist()
+    # by segment, then decreasing density (stable, as sorted(..., reverse=True))
+    order = np.lexsort((-rho, segments))
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+    # first hit of each segment (in this order), and the one of the segment of each hit
+    isTop = np.concatenate(([True], segments[order][1:] != segments[order][:-1]))
+    topRank = np.maximum.accumulate(np.where(isTop, np.arange(n), 0))[rank]
+    top = order[topRank]
+    dist2 = (x - x[top])**2 + (y - y[top])**2
+    maxDist2 = np.zeros(n, dtype=np.float64)
+    np.maximum.at(maxDist2, topRank, dist2)
+    far = np.flatnonzero(dist2 >= maxDist2[topRank] * (1. - tolerance))
+    for i, j in zip(top[far].tolist(), far.tolist()):
+        delta[i] = max(delta[i], pow(_distance2(xList, yList, i, j), 0.5))
+    todo = order[~isTop]
+    if(len(todo) > 0):
+        points = np.column_stack((x, y, _segmentCoordinate(x, y, 0., segments)))
+        kdtree = spatial.cKDTree(points)
+    for kNeighbours in k:
+        if(len(todo) == 0 or kNeighbours >= n):
+            break
+        idx = kdtree.query(points[todo], k=kNeighbours)[1]
+        sameSegment = segments[idx] == segments[todo][:, None]
+        dist2 = np.where(sameSegment, (x[idx] - x[todo][:, None])**2 + (y[idx] - y[todo][:, None])**2, np.inf)
+        dist2Higher = np.where(rank[idx] < rank[todo][:, None], dist2, np.inf)
+        minDist2 = dist2Higher.min(axis=1)
+        # no hit outside the k nearest can be as close (with a margin for the rounding of the KDTree distances)
+        resolved = minDist2 < dist2[:, -1] * (1. - tolerance)
+        closest = dist2Higher <= (minDist2 * (1. + tolerance))[:, None]
+        for i, iIdx, iClosest in zip(todo[resolved].tolist(), idx[resolved], closest[resolved]):
+            candidates = iIdx[iClosest]
+            candidates = candidates[np.argsort(rank[candidates])]
+            delta[i], nearestHigher[i] = _nearest(xList, yList, i, candidates.tolist())
+        todo = todo[~resolved]
+    for i in todo.tolist():
+        # brute force over all the hits of the segment with higher density
+        higher = order[topRank[i]:rank[i]]
+        dist2 = (x[higher] - x[i])**2 + (y[higher] - y[i])**2
+        candidates = higher[dist2 <= dist2.min() * (1. + tolerance)]
+        delta[i], nearestHigher[i] = _nearest(xList, yList, i, candidates.tolist())
+    return delta, nearestHigher
+
+
+# distance squared between the hits i and j, as in distanceReal2
+def _distance2(x, y, i, j):
+    return (pow(x[j] - x[i], 2) + pow(y[j] - y[i], 2))
+
+
+# closest of the candidates (in decreasing density order) to the hit i, the last one on ties
+def _nearest(x, y, i, candidates):
+    dist2 = float('inf')
+    nearestHigher = -1
+    for j in candidates:
+        tmp = _distance2(x, y, i, j)
+        if(tmp <= dist2):
+            dist2 = tmp
+            nearestHigher = j
+    return pow(dist2, 0.5), nearestHigher
+
+
+# difference in phi, in [-pi, pi]
+def deltaPhi(phi1, phi2):
+    dphi = phi1 - phi2
+    if(dphi > math.pi):
+        dphi -= 2 * math.pi
+    elif(dphi <= -math.pi):
+        dphi += 2 * math.pi
+    return dphi
 
 # distance squared (in eta/phi) between the two objects (hexels, clusters)
+
+
 def distanceDR2(Hex1, Hex2):
-    return (pow(Hex2.eta - Hex1.eta, 2) + pow(Hex2.phi - Hex1.phi, 2))
+    return (pow(Hex2.eta - Hex1.eta, 2) + pow(deltaPhi(Hex2.phi, Hex1.phi), 2))
 
 # distance squared (in x/y) between the two objects (hexels, clusters)
 
@@ -534,80 +975,194 @@ def distanceDR2(Hex1, Hex2):
 def distanceReal2(clust1, clust2):
     return (pow(clust2.x - clust1.x, 2) + pow(clust2.y - clust1.y, 2))
 
+
+# attributes of a list of hexels as arrays, taken at once from the HitStore when they are all views of the same one
+def hexelColumns(hexels, names):
+    store = hexels[0].store if (len(hexels) > 0 and isinstance(hexels[0], HexelView)) else None
+    if store is not None and all(isinstance(iNode, HexelView) and iNode.store is store for iNode in hexels):
+        indices = np.array([iNode.index for iNode in hexels], dtype=np.int64)
+        return [getattr(store, name)[indices] for name in names]
+    return [np.array([getattr(iNode, name) for iNode in hexels], dtype=np.bool_ if name == "isHalo" else np.float64) for name in names]
+
+
+# sums of the weights per group, in the order of the entries (np.bincount gives integers when there are no entries)
+def groupSum(labels, weights, nGroups):
+    return np.bincount(labels, weights=weights, minlength=nGroups).astype(np.float64, copy=False)
+
+# positions (based on hexels positions weighted by the energy, without the halo hexels) and energies of a list of
+# clusters, as x, y, z and energy arrays. Clusters with only halo hexels are at their most energetic hexel, and the
+# ones whose weights sum to 0 at 0, 0, 0 (their position could not be computed)
+
+
+def clusterPositions(clusters):
+    nClusters = len(clusters)
+    labels = np.repeat(np.arange(nClusters), [len(cluster) for cluster in clusters])
+    weight, x, y, z, isHalo = hexelColumns([iNode for cluster in clusters for iNode in cluster], ("weight", "x", "y", "z", "isHalo"))
+    return clusterPositionsByLabel(labels, nClusters, weight, x, y, z, isHalo)
+
+# the same, for the hexels given as arrays with the index of their cluster (labels) and the number of clusters
+
+
+def clusterPositionsByLabel(labels, nClusters, weight, x, y, z, isHalo):
+    # sums over the hexels that are not halo, in the order of the hexels
+    core = ~isHalo
+    total_weight = groupSum(labels[core], weight[core], nClusters)
+    position = [groupSum(labels[core], coordinate[core] * weight[core], nClusters) for coordinate in (x, y, z)]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        position = [np.where(total_weight != 0., coordinate / total_weight, 0.) for coordinate in position]
+    # haloOnlyCluster: position of the (first) most energetic hexel, above -1 (the nan weights are skipped)
+    haloOnly = np.flatnonzero(np.bincount(labels[core], minlength=nClusters) == 0)
+    hexels = np.flatnonzero(np.isin(labels, haloOnly))
+    if(len(hexels) > 0):
+        haloWeight = np.where(np.isnan(weight[hexels]), -np.inf, weight[hexels])
+        order = np.lexsort((hexels, -haloWeight, labels[hexels]))  # by cluster, then decreasing weight
+        hexels, haloWeight = hexels[order], haloWeight[order]
+        first = np.concatenate(([True], labels[hexels[1:]] != labels[hexels[:-1]]))
+        maxenergy = hexels[first & (haloWeight > -1.0)]
+        for coordinate, values in zip(position, (x, y, z)):
+            coordinate[labels[maxenergy]] = values[maxenergy]
+    return position[0], position[1], position[2], total_weight
+
+# positions of a list of multi-clusters (based on the positions of their 2D clusters weighted by the energy, without
+# the ones below 1% of the multi-cluster energy) and their energies, as x, y, z and energy arrays
+
+
+def multiClusterPositions(multiClusters):
+    nClusters = len(multiClusters)
+    labels = np.repeat(np.arange(nClusters), [len(multi_clu) for multi_clu in multiClusters])
+    energy, x, y, z = [np.array([getattr(layer_clu, name) for multi_clu in multiClusters for layer_clu in multi_clu], dtype=np.float64)
+                       for name in ("energy", "x", "y", "z")]
+    return multiClusterPositionsByLabel(labels, nClusters, energy, x, y, z)
+
+# the same, for the 2D clusters given as arrays with the index of their multi-cluster (labels) and the number of multi-clusters
+
+
+def multiClusterPositionsByLabel(labels, nClusters, energy, x, y, z):
+    mcenergy = groupSum(labels, energy, nClusters)
+    used = ~(energy < 0.01 * mcenergy[labels])  # cutoff < 1% layer energy contribution
+    # weight each corrdinate only by the total energy of the layer cluster
+    totweight = groupSum(labels[used], energy[used], nClusters)
+    position = [groupSum(labels[used], coordinate[used] * energy[used], nClusters) for coordinate in (x, y, z)]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        position = [np.where(totweight != 0, coordinate / totweight, coordinate) for coordinate in position]
+    for coordinate in position:
+        coordinate[mcenergy == 0] = 0.  # no position without energy (or 2D clusters)
+    return position[0], position[1], position[2], mcenergy
+
+# table of the multi-clusters (event, energy, x, y, z, eta, phi, nClusters) made of the rows of a ClusterTable of 2D
+# clusters (arrays of row indices, the seed first), and the index of the multi-cluster of each row (-1 if none)
+
+
+def multiClusterTable(clusters, multiClusters):
+    nClusters = len(multiClusters)
+    rows = np.concatenate([np.empty(0, dtype=np.int64)] + [np.asarray(temp, dtype=np.int64) for temp in multiClusters])
+    labels = np.repeat(np.arange(nClusters, dtype=np.int64), [len(temp) for temp in multiClusters])
+    x, y, z, energy = multiClusterPositionsByLabel(labels, nClusters, clusters.energy[rows], clusters.x[rows], clusters.y[rows], clusters.z[rows])
+    eta, phi = etaPhi(x, y, z)
+    multiCluster = np.full(len(clusters), -1, dtype=np.int64)
+    multiCluster[rows] = labels
+    seeds = np.array([temp[0] for temp in multiClusters], dtype=np.int64)
+    return ClusterTable([("event", clusters.event[seeds]), ("energy", energy), ("x", x), ("y", y), ("z", z), ("eta", eta), ("phi", phi),
+                         ("nClusters", np.bincount(labels, minlength=nClusters))]), multiCluster
+
+# pseudorapidity and azimuthal angle of x, y, z arrays, computed as ROOT.Math.XYZPoint does
+
+
+def etaPhi(x, y, z):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    z = np.asarray(z, dtype=np.float64)
+    rho = np.sqrt(x * x + y * y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        phi = np.where((x == 0.) & (y == 0.), 0., np.arctan2(y, x))
+        z_scaled = z / rho
+        # first order Taylor expansion of the sqrt for large z_scaled
+        eta = np.where(np.abs(z_scaled) < 8192., np.log(z_scaled + np.sqrt(z_scaled * z_scaled + 1.0)),
+                       np.where(z > 0, np.log(2.0 * z_scaled + 0.5 / z_scaled), -np.log(-2.0 * z_scaled)))
+    # case vector has rho = 0
+    eta = np.where(rho > 0, eta, np.where(z == 0, 0., np.where(z > 0, z + 22756.0, z - 22756.0)))
+    return eta, phi
+
 # position of the cluster, based on hexels positions weighted by the energy
 
 
 def calculatePosition(cluster):
-    total_weight = 0.
-    x = 0.
-    y = 0.
-    z = 0.
-    haloOnlyCluster = True
-
-    # check if haloOnlyCluster
-    for iNode in cluster:
-        if (not iNode.isHalo):
-            haloOnlyCluster = False
-
-    if (not haloOnlyCluster):
-        for iNode in cluster:
-            if(not iNode.isHalo):
-                total_weight += iNode.weight
-                x += iNode.x * iNode.weight
-                y += iNode.y * iNode.weight
-                z += iNode.z * iNode.weight
-        if (total_weight != 0.):
-            return ROOT.Math.XYZPoint(x / total_weight, y / total_weight, z / total_weight)  # return as ROOT.Math.XYZPoint
-        else:
-            return ROOT.Math.XYZPoint()
-    if (haloOnlyCluster):
-        maxenergy = - 1.0
-        maxenergy_x, maxenergy_y, maxenergy_z = 0., 0., 0.
-        for iNode in cluster:
-            if (iNode.weight > maxenergy):
-                maxenergy = iNode.weight
-                maxenergy_x = iNode.x
-                maxenergy_y = iNode.y
-                maxenergy_z = iNode.z
-        return ROOT.Math.XYZPoint(maxenergy_x, maxenergy_y, maxenergy_z)
+    x, y, z, energy = clusterPositions([cluster])
+    return Point(x[0].item(), y[0].item(), z[0].item())
 
 
 # get position of the multi-cluster, based on the positions of its 2D clusters weighted by the energy
 def getMultiClusterPosition(multi_clu):
-    if(len(multi_clu) == 0):
-        return ROOT.Math.XYZPoint()
-    mcenergy = getMultiClusterEnergy(multi_clu)
-    if (mcenergy == 0):
-        return ROOT.Math.XYZPoint()
-
-    # compute weighted mean x/y/z position
-    acc_x = 0.0
-    acc_y = 0.0
-    acc_z = 0.0
-    totweight = 0.0
-    for layer_clu in multi_clu:
-        if(layer_clu.energy < 0.01 * mcenergy):
-            continue  # cutoff < 1% layer energy contribution
-        weight = layer_clu.energy  # weight each corrdinate only by the total energy of the layer cluster
-        acc_x += layer_clu.x * weight
-        acc_y += layer_clu.y * weight
-        acc_z += layer_clu.z * weight
-        totweight += weight
-    if (totweight != 0):
-        acc_x /= totweight
-        acc_y /= totweight
-        acc_z /= totweight
-
-    return ROOT.Math.XYZPoint(acc_x, acc_y, acc_z)  # return x/y/z in absolute coordinates
+    x, y, z, energy = multiClusterPositions([multi_clu])
+    return Point(x[0].item(), y[0].item(), z[0].item())  # return x/y/z in absolute coordinates
 
 # get energy of the multi-cluster, based on its 2D clusters
 
 
 def getMultiClusterEnergy(multi_clu):
-    acc = 0.
-    for layer_clu in multi_clu:
-        acc += layer_clu.energy
-    return acc
+    return multiClusterPositions([multi_clu])[3][0].item()
+
+
+# sigma noise (in GeV) per layer (rows) and silicon thickness index (columns: 100, 200, 300 um), made at the first use
+_sigmaNoiseTable = None
+
+
+def sigmaNoiseTable():
+    global _sigmaNoiseTable
+    if _sigmaNoiseTable is None:
+        RecHitCalib = RecHitCalibration()
+        # for BH (layer > lastLayerFH) the thickness index does not play a role
+        _sigmaNoiseTable = np.array([[0.001 * RecHitCalib.sigmaNoiseMeV(layer, thickIndex) for thickIndex in range(0, 3)]
+                                     for layer in range(0, HGCalImagingAlgo.maxlayer + 1)], dtype=np.float64)
+    return _sigmaNoiseTable
+
+# silicon thickness index of the hits (0, 1, 2 for 100, 200, 300 um), -1 for BH and nonsensical values (same noise as 300 um)
+
+
+def thicknessIndex(layers, thicknesses):
+    layers = np.asarray(layers, dtype=np.int64)
+    thicknesses = np.asarray(thicknesses, dtype=np.float64)
+    thickIndex = np.full(len(layers), -1, dtype=np.int64)
+    for index, thickness in enumerate((100., 200., 300.)):
+        thickIndex[(thicknesses > thickness - 1.) & (thicknesses < thickness + 1.)] = index
+    silicon = layers <= HGCalImagingAlgo.lastLayerFH  # EE + FH
+    if((silicon & (thickIndex == -1)).any()):
+        print("ERROR - silicon thickness has a nonsensical value")
+    thickIndex[~silicon] = -1
+    return thickIndex
+
+# determine if the energies of the hits are above the desired treshold, returns the sigma noise and the mask
+# (with dependSensor, the hits of layers without noise in the table are never above it and get a nan noise)
+
+
+def aboveThreshold(layers, thicknesses, energies, ecut, dependSensor=True):
+    energies = np.asarray(energies, dtype=np.float64)
+    if(dependSensor):
+        layers = np.asarray(layers, dtype=np.int64)
+        # determine noise for each sensor/subdetector from the RecHitCalibration table
+        known = (layers >= 0) & (layers <= HGCalImagingAlgo.maxlayer)
+        sigmaNoise = np.full(len(energies), np.nan, dtype=np.float64)
+        sigmaNoise[known] = sigmaNoiseTable()[layers[known], thicknessIndex(layers[known], np.asarray(thicknesses)[known])]
+    else:
+        sigmaNoise = np.ones(len(energies), dtype=np.float64)
+    with np.errstate(invalid="ignore"):  # nan noise: not above
+        return sigmaNoise, energies >= ecut * sigmaNoise  # this checks if energies are above the threshold of ecut (times the sigma noise for the sensor, if that option is set)
+
+# attributes of all the rechits of a collection (names of the rechit methods), read from the ntuple columns when possible
+
+
+def recHitColumns(rHitsCollection, methods):
+    if hasattr(rHitsCollection, "column"):
+        return dict((method, np.asarray(rHitsCollection.column(method))) for method in methods)
+    rHits = list(rHitsCollection)
+    return dict((method, np.array([getattr(rHit, method)() for rHit in rHits])) for method in methods)
+
+# determine which rechits of a collection are above the desired treshold, returns the sigma noise and the mask
+
+
+def recHitsAboveThreshold(rHitsCollection, ecut, dependSensor=True):
+    columns = recHitColumns(rHitsCollection, ("layer", "thickness", "energy"))
+    return aboveThreshold(columns["layer"], columns["thickness"], columns["energy"], ecut, dependSensor)
 
 # determine if the rechit energy is above the desired treshold
 
@@ -615,20 +1170,9 @@ def getMultiClusterEnergy(multi_clu):
 def recHitAboveThreshold(rHit, ecut, dependSensor=True):
     sigmaNoise = 1.
     if(dependSensor):
-        thickIndex = -1
-        if(rHit.layer() <= HGCalImagingAlgo.lastLayerFH):  # EE + FH
-            thickness = rHit.thickness()
-            if(thickness > 99. and thickness < 101.):
-                thickIndex = 0
-            elif(thickness > 199. and thickness < 201.):
-                thickIndex = 1
-            elif(thickness > 299. and thickness < 301.):
-                thickIndex = 2
-            else:
-                print("ERROR - silicon thickness has a nonsensical value")
-        # determine noise for each sensor/subdetector using RecHitCalibration library
-        RecHitCalib = RecHitCalibration()
-        sigmaNoise = 0.001 * RecHitCalib.sigmaNoiseMeV(rHit.layer(), thickIndex)  # returns threshold for EE, FH, BH (in case of BH thickIndex does not play a role)
+        sigmaNoise = float("nan")  # never above the threshold for the layers without noise in the table
+        if(0 <= rHit.layer() <= HGCalImagingAlgo.maxlayer):
+            sigmaNoise = sigmaNoiseTable()[rHit.layer(), thicknessIndex([rHit.layer()], [rHit.thickness()])[0]].item()
     aboveThreshold = rHit.energy() >= ecut * sigmaNoise  # this checks if rechit energy is above the threshold of ecut (times the sigma noise for the sensor, if that option is set)
     return sigmaNoise, aboveThreshold
 
@@ -1,10 +1,29 @@
 # import math
 # import collections
+from collections import OrderedDict, namedtuple
+import functools
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-import ROOT
 import numpy as np
 import pandas as pd
-import root_numpy as rnp
+try:
+    import ROOT
+    import root_numpy as rnp
+except ImportError:
+    # without ROOT only the ColumnarStore and MemoryBackend can be read
+    ROOT = None
+    rnp = None
 
 
 class _Collection(object):
@@ -30,7 +49,7 @@ class _Collection(object):
 
     def size(self):
         """Number of objects in the collection."""
-        return int(getattr(self._tree, self._sizeBranch).size())
+        return len(getattr(self._tree, self._sizeBranch))
 
     def __len__(self):
         """Number of objects in the collection."""
@@ -45,6 +64,10 @@ class _Collection(object):
         for index in range(self.size()):
             yield self._objclass(self._tree, index, self._prefix)
 
+    def column(self, attr):
+        """Returns the values of a member variable (<prefix>_<attr>) for all the objects at once."""
+        return getattr(self._tree, self._prefix + "_" + attr)
+
 
 class _Object(object):
     """Adaptor class representing a single object in a collection.
@@ -75,6 +98,8 @@ class _Object(object):
         """
         self._checkIsValid()
         val = getattr(self._tree, self._prefix + "_" + attr)[self._index]
+        if isinstance(val, np.generic):
+            val = val.item()  # plain python number, as returned by PyROOT
         return lambda: val
 
     def _checkIsValid(self):
@@ -91,6 +116,70 @@ class _Object(object):
         return self._index
 
 
+##########
+PrefixSchema = namedtuple("PrefixSchema", ["branches", "names", "dtypes"])
+
+
+class NtupleSchema(object):
+    """Class describing the branches of an ntuple, grouped by prefix.
+
+    It is built once when the ntuple is opened and shared by all its
+    events. For each prefix it holds the tuples of the branch names,
+    of the corresponding column names (the branch names without
+    '<prefix>_') and of their NumPy dtypes (object for the branches
+    that do not map onto a plain NumPy type, e.g. vector<vector<>>).
+    """
+
+    def __init__(self, branchTypes):
+        """Constructor.
+
+        Arguments:
+        branchTypes -- List of (branch name, type name) pairs, e.g. ('rechit_x', 'vector<float>')
+        """
+        super(NtupleSchema, self).__init__()
+        self._typeNames = dict(branchTypes)
+        self._branches = tuple(branch for branch, typeName in branchTypes)
+        grouped = OrderedDict()
+        for branch, typeName in branchTypes:
+            if "_" in branch:
+                grouped.setdefault(branch.split("_", 1)[0], []).append(branch)
+        self._prefixes = dict((prefix, self._makePrefixSchema(prefix, branches))
+                              for prefix, branches in grouped.items())
+
+    @classmethod
+    def fromTree(cls, tree):
+        """Builds the schema from the list of branches of a TTree."""
+        return cls([(br.GetName(), br.GetClassName() or br.GetListOfLeaves()[0].GetTypeName())
+                    for br in tree.GetListOfBranches()])
+
+    def _makePrefixSchema(self, prefix, branches):
+        return PrefixSchema(tuple(branches),
+                            tuple(branch[len(prefix)+1:] for branch in branches),
+                            tuple(_dtype(self._typeNames[branch]) for branch in branches))
+
+    def branches(self):
+        """Returns the tuple of all the branch names."""
+        return self._branches
+
+    def hasBranch(self, branch):
+        return branch in self._typeNames
+
+    def typeName(self, branch):
+        """Returns the C++ type name of a branch, None if there is no such branch."""
+        return self._typeNames.get(branch)
+
+    def prefixes(self):
+        """Returns the sorted list of prefixes."""
+        return sorted(self._prefixes)
+
+    def prefix(self, prefix):
+        """Returns the PrefixSchema of the branches starting with '<prefix>_'."""
+        if prefix in self._prefixes:
+            return self._prefixes[prefix]
+        return self._makePrefixSchema(prefix, [branch for branch in self._branches
+                                               if branch.startswith(prefix + "_")])
+
+
 ##########
 class HGCalNtuple(object):
     """Class abstracting the whole ntuple/TTree.
@@ -99,34 +188,147 @@ class HGCalNtuple(object):
     - iterating over events
     - querying whether hit/seed information exists
 
+    Several files can be read as one ntuple, the TTrees being chained
+    in a TChain; entry numbers are then global to the whole chain.
+    A ColumnarStore directory, or any NtupleBackend, can be read
+    instead of ROOT files, with the same interface.
+
     Note that to iteratate over the evets with zip(), you should use
     itertools.izip() instead.
     """
 
-    def __init__(self, fileName, tree="ana/hgc"):
+    # branches never disabled by selectBranches()
+    eventIdBranches = ("run", "lumi", "event")
+
+    def __init__(self, fileName, tree="ana/hgc", cacheSize=30000000, learnEntries=10, threads=0):
         """Constructor.
 
         Arguments:
-        fileName -- String for path to the ROOT file
-        tree     -- Name of the TTree object inside the ROOT file (default: 'ana/hgc')
+        fileName     -- String for path to the ROOT file, or list of them; local paths may contain wildcards.
+                        Can also be the directory of a ColumnarStore, or an NtupleBackend object.
+        tree         -- Name of the TTree object inside the ROOT file (default: 'ana/hgc')
+        cacheSize    -- Size in bytes of the TTreeCache, 0 to disable it (default: 30 MB)
+        learnEntries -- Number of entries during which the TTreeCache learns the branches to prefetch (default: 10)
+        threads      -- Number of threads ROOT uses to read and decompress the baskets (default: 0, no implicit MT)
         """
         super(HGCalNtuple, self).__init__()
-        self._file = ROOT.TFile.Open(fileName)
-        self._tree = self._file.Get(tree)
-        self._entries = self._tree.GetEntriesFast()
+        if isinstance(fileName, NtupleBackend):
+            self._fileNames = []
+            self._backend = fileName
+        else:
+            self._fileNames = _expandFileNames(fileName)
+            if len(self._fileNames) == 1 and ColumnarStore.isStore(self._fileNames[0]):
+                self._backend = ColumnarStore(self._fileNames[0])
+            else:
+                self._backend = TreeBackend.fromFiles(self._fileNames, tree, cacheSize, learnEntries, threads)
+            fileName = self._fileNames
+        # arguments to reopen the same ntuple, e.g. in the map_reduce() workers
+        self._openArgs = (fileName, tree, cacheSize, learnEntries, threads)
+        self._entries = self._backend.entries()
+        self._schema = self._backend.schema()
+        self._learnEvents = None
+        self._usedBranches = None
+        self._selection = None
+        # reading times of the worker processes of map_reduce()
+        self._workerIoTimes = _Stopwatch()
 
     def file(self):
-        return self._file
+        """Returns the currently loaded ROOT file (None when not reading ROOT files)."""
+        return self._backend.file()
+
+    def fileNames(self):
+        return self._fileNames
+
+    def backend(self):
+        """Returns the NtupleBackend the events are read from."""
+        return self._backend
 
     def tree(self):
-        return self._tree
+        """Returns the TTree read, None when not reading ROOT files."""
+        if isinstance(self._backend, TreeBackend):
+            return self._backend.tree()
+        return None
+
+    def store(self):
+        """Returns the ColumnarStore read, None when not reading a store."""
+        if isinstance(self._backend, ColumnarStore):
+            return self._backend
+        return None
 
     def nevents(self):
         return self._entries
 
+    def schema(self):
+        """Returns the NtupleSchema of the ntuple."""
+        return self._schema
+
+    def ioReport(self):
+        """Returns a summary of the time spent reading the events.
+
+        The times of the worker processes of map_reduce() are included,
+        summed over the workers. The CPU time of the process during the
+        reading minus its wall time shows how much the reading ran in
+        parallel (e.g. ROOT implicit MT), it is not a measure of the time
+        saved by the cache or the threads. The CPU time is not given when
+        the events were read outside of the main thread (iterate_chunks()
+        with prefetch), as it then includes the work of the other threads.
+        """
+        wall, cpu, shared = self._backend.ioTimes()
+        workerWall, workerCpu, workerShared = self._workerIoTimes.times()
+        wall, cpu = wall + workerWall, cpu + workerCpu
+        if shared or workerShared:
+            return "I/O: %.1f s wall (no CPU time when prefetching)" % wall
+        return "I/O: %.1f s wall, %.1f s CPU, %.1f s cpu - wall (parallelism)" % (wall, cpu, cpu - wall)
+
     def hasRawRecHits(self):
         """Returns true if the ntuple has raw RecHit information."""
-        return hasattr(self._tree, "rechit_raw_pt")
+        return self._schema.hasBranch("rechit_raw_pt")
+
+    def selectBranches(self, prefixes=(), branches=()):
+        """Disables all the branches of the TTree, except for the requested ones.
+
+        Disabled branches are not read anymore by GetEntry(), accessing
+        them afterwards returns stale values. The event id branches
+        (run, lumi, event) are always kept active. Does nothing for the
+        other backends, which read the branches only when accessed.
+
+        Arguments:
+        prefixes -- List of prefixes whose branches (<prefix>_*) are kept active
+        branches -- List of single branch names kept active
+        """
+        self._backend.setBranchStatus("*", 0)
+        for branch in self.eventIdBranches + tuple(branches):
+            self._backend.setBranchStatus(branch, 1)
+        for prefix in prefixes:
+            self._backend.setBranchStatus(prefix + "_*", 1)
+
+    def resetBranches(self):
+        """Enables all the branches of the TTree again."""
+        self._backend.setBranchStatus("*", 1)
+
+    def learnBranches(self, nEvents=10):
+        """Turns on the learning mode for the next iteration over the events.
+
+        The branches accessed through the objects and getDataFrame() of the
+        first nEvents events are recorded, and all the other branches are
+        disabled with selectBranches() for the remaining events.
+
+        Arguments:
+        nEvents -- Number of events used for learning (default: 10)
+        """
+        self._learnEvents = nEvents
+        self._usedBranches = set()
+
+    def usedBranches(self):
+        """Returns the sorted list of branches recorded in learning mode."""
+        if self._usedBranches is None:
+            return []
+        return sorted(self._usedBranches)
+
+    def _pruneBranches(self):
+        """Keeps active only the branches recorded in learning mode."""
+        self.selectBranches(branches=tuple(self._usedBranches & set(self._schema.branches())))
+        self._learnEvents = None
 
     def __iter__(self):
         """Returns generator for iterating over TTree entries (events)
@@ -134,28 +336,590 @@ class HGCalNtuple(object):
         Generator returns Event objects.
 
         """
-        for jentry in range(self._entries):
-            # get the next tree in the chain and verify
-            ientry = self._tree.LoadTree(jentry)
-            if ientry < 0:
-                break
-            # copy next entry into memory and verify
-            nb = self._tree.GetEntry(jentry)
-            if nb <= 0:
+        return self.events()
+
+    def events(self, start=0, stop=None):
+        """Returns generator for iterating over the entries [start, stop)
+
+        Generator returns Event objects. Only the selected entries are
+        read if a selection was set, see build_selection().
+
+        Arguments:
+        start -- First entry (default: 0)
+        stop  -- Entry following the last one (default: None, up to the last entry)
+        """
+        if stop is None or stop > self._entries:
+            stop = self._entries
+        nLearned = 0
+        for jentry in self.selectedEntries(start, stop).tolist():
+            if self._learnEvents is not None and nLearned >= self._learnEvents:
+                self._pruneBranches()
+            if not self._backend.load(jentry):
                 continue
 
-            yield Event(self._tree, jentry)
+            if self._learnEvents is not None:
+                nLearned += 1
+                yield Event(self._backend, jentry, schema=self._schema, usedBranches=self._usedBranches)
+            else:
+                yield Event(self._backend, jentry, schema=self._schema)
 
     def getEvent(self, index):
-        """Returns Event for a given index"""
-        ientry = self._tree.LoadTree(index)
-        if ientry < 0:
+        """Returns Event for a given (global) entry number"""
+        if not self._backend.load(index):
             return None
-        nb = self._tree.GetEntry(ientry)  # ientry or jentry?
-        if nb <= 0:
-            None
 
-        return Event(self._tree, ientry)  # ientry of jentry?
+        return Event(self._backend, index, schema=self._schema)
+
+    def iterate_chunks(self, prefixes, chunk_size=100, start=0, stop=None, prefetch=0):
+        """Returns generator for reading the TTree in chunks of events.
+
+        Generator returns EventChunk objects. Each chunk is read with a
+        single NtupleBackend.read() call (one tree2array call for the
+        TTree), which is much cheaper than reading the events one by one.
+
+        If a selection was set (see build_selection()), the chunks hold
+        chunk_size selected entries, only the runs of consecutive selected
+        entries being read.
+
+        With prefetch, the chunks are read by a background thread while
+        the previous ones are processed, at most prefetch chunks being
+        held in memory ahead of the caller. The ntuple must then not be
+        read otherwise (e.g. with events()) until the iteration is over.
+        The thread safety of ROOT is enabled for the TTree, as the caller
+        may use PyROOT meanwhile, and the columns of a ColumnarStore are
+        copied into memory by the thread (they are otherwise memory-mapped,
+        and only read from the files when accessed by the caller).
+
+        Arguments:
+        prefixes   -- List of branch prefixes to read (e.g. ['genpart', 'rechit'])
+        chunk_size -- Number of events per chunk (default: 100)
+        start      -- First entry (default: 0)
+        stop       -- Entry following the last one (default: None, up to the last entry)
+        prefetch   -- Number of chunks read ahead in a background thread (default: 0, no background reading)
+        """
+        if stop is None or stop > self._entries:
+            stop = self._entries
+        if prefetch <= 0:
+            return self._readChunks(prefixes, chunk_size, start, stop)
+        self._backend.enableThreads()
+        return _prefetch(self._readChunks(prefixes, chunk_size, start, stop, inMemory=True), prefetch)
+
+    def _readChunks(self, prefixes, chunk_size, start, stop, inMemory=False):
+        """Returns generator reading the chunks of iterate_chunks(), copied into memory with inMemory (see _inMemory())."""
+        branches = [branch for prefix in prefixes for branch in self._schema.prefix(prefix).branches]
+        if self._selection is None:
+            for first in range(start, stop, chunk_size):
+                last = min(first + chunk_size, stop)
+                columns = self._backend.read(branches, first, last)
+                if inMemory:
+                    columns = _inMemory(columns)
+                yield EventChunk(columns, self._schema, prefixes, first, last)
+            return
+        selected = self.selectedEntries(start, stop)
+        for first in range(0, len(selected), chunk_size):
+            entries = selected[first:first + chunk_size]
+            # read each run of consecutive entries in one go
+            runs = np.split(entries, np.flatnonzero(np.diff(entries) != 1) + 1)
+            columns = _concatenate([self._backend.read(branches, run[0], run[-1] + 1) for run in runs], branches)
+            if inMemory:
+                columns = _inMemory(columns)
+            yield EventChunk(columns, self._schema, prefixes, entries[0], entries[-1] + 1, entries)
+
+    def selectedEntries(self, start=0, stop=None):
+        """Returns the entries in [start, stop) to be read, all of them if no selection was set."""
+        if stop is None or stop > self._entries:
+            stop = self._entries
+        if self._selection is None:
+            return np.arange(start, stop)
+        return self._selection[np.searchsorted(self._selection, start):np.searchsorted(self._selection, stop)]
+
+    def selection(self):
+        """Returns the array of the selected entries, None if no selection was set."""
+        return self._selection
+
+    def setSelection(self, entries):
+        """Restricts events(), iterate_chunks() and map_reduce() to some entries.
+
+        Arguments:
+        entries -- Sequence of entry numbers, or None to read all the entries again
+        """
+        if entries is not None:
+            entries = np.unique(np.asarray(entries, dtype=np.int64))
+        self._selection = entries
+
+    def clearSelection(self):
+        """Reads all the entries again."""
+        self.setSelection(None)
+
+    def build_selection(self, name, expr, prefixes=("genpart",), chunk_size=1000, directory=None):
+        """Selects the events passing a cut, and stores their entries for later runs.
+
+        The cut is evaluated in bulk over chunks of events holding only
+        the (cheap) branches of the given prefixes. The surviving entries
+        are saved as <name>.<hash>.selection.npz, hash being a short hash
+        of the file names so that the selections of different samples do
+        not overwrite each other, together with the files and the number
+        of entries they belong to. They are read back with loadSelection(),
+        and the selection is set on this ntuple.
+
+        Arguments:
+        name       -- Name of the selection
+        expr       -- Function called as expr(chunk) with an EventChunk, returning a boolean per event of the chunk
+        prefixes   -- List of branch prefixes read for the cut (default: ('genpart',))
+        chunk_size -- Number of events read at a time (default: 1000)
+        directory  -- Directory of the file (default: None, next to the ntuple for local files and
+                      ColumnarStores, the current directory otherwise)
+
+        Returns the array of the selected entries.
+        """
+        self.clearSelection()
+        selected = [chunk.entries()[np.asarray(expr(chunk), dtype=bool)]
+                    for chunk in self.iterate_chunks(prefixes, chunk_size)]
+        entries = np.concatenate(selected) if len(selected) > 0 else np.empty(0, dtype=np.int64)
+        np.savez(self._selectionPath(name, directory), entries=entries,
+                 files=np.array(self._fileNames), nevents=self._entries)
+        self.setSelection(entries)
+        return self._selection
+
+    def loadSelection(self, name, directory=None):
+        """Sets the selection stored by build_selection(), returns the array of the selected entries.
+
+        Raises a ValueError if the selection was built on other files.
+        """
+        with np.load(self._selectionPath(name, directory)) as stored:
+            if list(stored["files"]) != list(self._fileNames) or int(stored["nevents"]) != self._entries:
+                raise ValueError("selection %s was built for another ntuple" % name)
+            self.setSelection(stored["entries"])
+        return self._selection
+
+    def _selectionPath(self, name, directory):
+        """Returns the path of the file of a selection, for the files of this ntuple."""
+        if directory is None:
+            directory = "."
+            if len(self._fileNames) > 0 and "://" not in self._fileNames[0]:
+                directory = self._fileNames[0] if self.store() is not None else os.path.dirname(self._fileNames[0])
+        filesHash = hashlib.sha1("\n".join(self._fileNames).encode("utf-8")).hexdigest()[:10]
+        return os.path.join(directory, "%s.%s.selection.npz" % (name, filesHash))
+
+    def map_reduce(self, func, reducer, n_workers=None, n_blocks=None):
+        """Processes blocks of entries in parallel and combines their results.
+
+        The entries are split into n_blocks contiguous blocks, each of them
+        processed in a worker process which opens its own HGCalNtuple on
+        the same files and calls func(ntuple, start, stop). The results of
+        the blocks are then combined in block order with reducer(), like
+        reduce(reducer, results) would do. With a single worker the blocks
+        are processed in the current process, on this ntuple.
+
+        func, reducer and the results have to be picklable, e.g. functions
+        defined at module level or functools.partial objects of them.
+
+        Arguments:
+        func      -- Function called as func(ntuple, start, stop) for each block
+        reducer   -- Function combining two results into one
+        n_workers -- Number of worker processes (default: None, the number of CPUs)
+        n_blocks  -- Number of blocks (default: None, n_workers)
+        """
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        if n_blocks is None:
+            n_blocks = n_workers
+        bounds = np.linspace(0, self._entries, max(n_blocks, 1) + 1).astype(int)
+        if self._selection is not None:
+            # blocks with the same number of selected entries
+            positions = np.linspace(0, len(self._selection), max(n_blocks, 1) + 1).astype(int)
+            bounds = np.append(self._selection, self._entries)[positions]
+            bounds[0] = 0
+        blocks = [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start] or [(0, 0)]
+        if n_workers <= 1:
+            results = [func(self, start, stop) for start, stop in blocks]
+        else:
+            pool = multiprocessing.Pool(min(n_workers, len(blocks)))
+            try:
+                outputs = pool.map(_processBlock, [(self._openArgs, self._selection, func, start, stop)
+                                                   for start, stop in blocks], 1)
+            finally:
+                pool.close()
+                pool.join()
+            results = [result for result, ioTimes in outputs]
+            for result, ioTimes in outputs:
+                self._workerIoTimes.add(*ioTimes)
+        return functools.reduce(reducer, results)
+
+    def writeColumnarStore(self, directory, prefixes=None, chunk_size=100):
+        """Writes the ntuple into a ColumnarStore, see ColumnarStore.write()."""
+        ColumnarStore.write(self, directory, prefixes, chunk_size)
+
+
+def _prefetch(items, size):
+    """Returns generator yielding the items of an iterable, consumed by a background thread.
+
+    The thread stays at most size items ahead of the caller. Exceptions
+    raised while producing the items are raised again in the caller, and
+    the thread is stopped when the generator is closed before the end.
+    """
+    buffer = queue.Queue(size)
+    stopped = threading.Event()
+    end = object()
+
+    def produce():
+        try:
+            for item in items:
+                # wait for some room in the buffer, unless the caller is gone
+                while not stopped.is_set():
+                    try:
+                        buffer.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stopped.is_set():
+                    return
+            buffer.put((end, None))
+        except Exception:
+            buffer.put((end, sys.exc_info()[1]))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is end:
+                break
+            yield item
+    finally:
+        stopped.set()
+        # unblock the producer if it is waiting on a full buffer, then let it finish
+        while thread.is_alive():
+            try:
+                buffer.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
+
+
+def _processBlock(args):
+    """Runs func(ntuple, start, stop) on a newly opened ntuple, for map_reduce().
+
+    Returns the result and the reading times of the ntuple.
+    """
+    openArgs, selection, func, start, stop = args
+    ntuple = HGCalNtuple(*openArgs)
+    ntuple.setSelection(selection)
+    result = func(ntuple, start, stop)
+    return result, ntuple._backend.ioTimes()
+
+
+def _concatenate(parts, branches):
+    """Concatenates the (values, offsets) columns read for consecutive ranges of entries."""
+    columns = OrderedDict()
+    for branch in branches:
+        values = [part[branch][0] for part in parts]
+        offsets = [part[branch][1] for part in parts]
+        shifts = np.cumsum([0] + [offset[-1] for offset in offsets[:-1]])
+        columns[branch] = (np.concatenate(values),
+                           np.concatenate([offsets[0][:1]] + [offset[1:] + shift for offset, shift in zip(offsets, shifts)]))
+    return columns
+
+
+def _inMemory(columns):
+    """Returns the columns read by NtupleBackend.read() with the memory-mapped arrays (of a ColumnarStore) copied into memory."""
+    loaded = OrderedDict()
+    for branch, (values, offsets) in columns.items():
+        if values.dtype == np.object_:
+            copied = np.empty(len(values), dtype=np.object_)
+            for index, item in enumerate(values):
+                copied[index] = np.array(item) if isinstance(item, np.memmap) else item
+            values = copied
+        elif isinstance(values, np.memmap):
+            values = np.array(values)
+        loaded[branch] = (values, np.array(offsets) if isinstance(offsets, np.memmap) else offsets)
+    return loaded
+
+
+def _expandFileNames(fileName):
+    """Returns the list of files for a path or list of paths.
+
+    Wildcards in local paths are expanded, remote (xrootd) paths
+    are kept as they are.
+    """
+    if not isinstance(fileName, (list, tuple)):
+        fileName = [fileName]
+    fileNames = []
+    for name in fileName:
+        if "://" not in name and glob.has_magic(name):
+            fileNames += sorted(glob.glob(name))
+        else:
+            fileNames.append(name)
+    if len(fileNames) == 0:
+        raise IOError("no file matching %s" % ", ".join(fileName))
+    return fileNames
+
+
+##########
+class EventChunk(object):
+    """Class abstracting a contiguous block of events read in one go.
+
+    For each prefix the branches are stored as flat NumPy arrays,
+    the objects of the i-th event of the chunk being found at
+    [offsets[i]:offsets[i+1]] of each of them.
+    """
+
+    def __init__(self, columns, schema, prefixes, start, stop, entries=None):
+        """Constructor.
+
+        Arguments:
+        columns  -- Dictionary of the (values, offsets) of the branches, as returned by NtupleBackend.read()
+        schema   -- NtupleSchema of the ntuple
+        prefixes -- List of branch prefixes contained in columns
+        start    -- Entry number of the first event of the chunk
+        stop     -- Entry number following the last event of the chunk
+        entries  -- Entry numbers of the events, if not all the entries in [start, stop) (default: None)
+        """
+        super(EventChunk, self).__init__()
+        self._start = start
+        self._stop = stop
+        if entries is None:
+            entries = np.arange(start, stop)
+        self._entries = entries
+        self._columns = {}
+        self._offsets = {}
+        for prefix in prefixes:
+            prefixSchema = schema.prefix(prefix)
+            prefixColumns = OrderedDict()
+            for branch, name in zip(prefixSchema.branches, prefixSchema.names):
+                values, offsets = columns[branch]
+                prefixColumns[name] = values
+                if branch == prefix + "_pt" or prefix not in self._offsets:
+                    self._offsets[prefix] = offsets
+            self._columns[prefix] = prefixColumns
+
+    def start(self):
+        return self._start
+
+    def stop(self):
+        return self._stop
+
+    def entries(self):
+        """Returns the entry numbers of the events of the chunk."""
+        return self._entries
+
+    def nevents(self):
+        return len(self._entries)
+
+    def __len__(self):
+        """Number of events in the chunk."""
+        return self.nevents()
+
+    def __iter__(self):
+        """Returns generator for the events of the chunk.
+
+        Generator returns ChunkedEvent objects.
+        """
+        for index in range(self.nevents()):
+            yield ChunkedEvent(self, index)
+
+    def offsets(self, prefix):
+        """Returns the per-event offsets (length nevents()+1) for a prefix."""
+        return self._offsets[prefix]
+
+    def columns(self, prefix):
+        """Returns dictionary of the flat arrays of a prefix, keyed by column name."""
+        return self._columns[prefix]
+
+    def column(self, prefix, name):
+        """Returns the flat array of a single branch (<prefix>_<name>)."""
+        return self._columns[prefix][name]
+
+    def jaggedColumn(self, prefix, name, index=None):
+        """Returns the JaggedColumn of a vector<vector<>> branch (<prefix>_<name>).
+
+        The rows are the objects of all the events of the chunk, or
+        only of the index-th event if index is given.
+        """
+        objects = self._columns[prefix][name]
+        if index is not None:
+            objects = objects[self._offsets[prefix][index]:self._offsets[prefix][index+1]]
+        return JaggedColumn.fromObjects(objects)
+
+    def getDataFrame(self, prefix, index, columns=None, float32=False, index_dtype=None):
+        """Returns the DataFrame of a prefix for the index-th event of the chunk.
+
+        See Event.getDataFrame() for the other arguments.
+        """
+        first, last = self._offsets[prefix][index], self._offsets[prefix][index+1]
+        if columns is None:
+            columns = list(self._columns[prefix].keys())
+        return _makeDataFrame([(name, self._columns[prefix][name][first:last]) for name in columns],
+                              float32, index_dtype)
+
+
+class ChunkedEvent(object):
+    """Class abstracting a single event inside an EventChunk.
+
+    Provides the same entry() and getDataFrame() interface as Event.
+    """
+
+    def __init__(self, chunk, index):
+        """Constructor.
+
+        Arguments:
+        chunk -- EventChunk object
+        index -- Index of the event inside the chunk
+        """
+        super(ChunkedEvent, self).__init__()
+        self._chunk = chunk
+        self._index = index
+
+    def entry(self):
+        return int(self._chunk.entries()[self._index])
+
+    def getDataFrame(self, prefix, columns=None, float32=False, index_dtype=None):
+        return self._chunk.getDataFrame(prefix, self._index, columns, float32, index_dtype)
+
+    def getJaggedColumn(self, prefix, name):
+        return self._chunk.jaggedColumn(prefix, name, self._index)
+
+
+def _project(prefixSchema, columns):
+    """Returns the PrefixSchema of a subset of the columns, in the given order."""
+    positions = []
+    for name in columns:
+        if name not in prefixSchema.names:
+            raise KeyError("no column %s" % name)
+        positions.append(prefixSchema.names.index(name))
+    return PrefixSchema(*[tuple(field[position] for position in positions) for field in prefixSchema])
+
+
+def _makeDataFrame(columns, float32=False, index_dtype=None):
+    """Returns the DataFrame of a list of (name, array) columns, see Event.getDataFrame()."""
+    return pd.DataFrame(OrderedDict((name, _compact(values, float32, index_dtype)) for name, values in columns),
+                        columns=[name for name, values in columns])
+
+
+def _compact(values, float32, index_dtype):
+    """Casts an array to the compact types requested in getDataFrame()."""
+    if values.dtype == np.object_:
+        if (not float32 and index_dtype is None) or len(values) == 0:
+            return values
+        # cast the flat values of all the rows at once, the rows of a branch having the same type
+        column = JaggedColumn.fromObjects(values)
+        flat = _compact(column.values, float32, index_dtype)
+        if flat.dtype == column.values.dtype:
+            return values
+        result = np.empty(len(values), dtype=np.object_)
+        for index, item in enumerate(np.split(flat, column.offsets[1:-1])):
+            result[index] = item
+        return result
+    if float32 and values.dtype == np.float64:
+        return values.astype(np.float32)
+    if index_dtype is not None and values.dtype.kind == "i":
+        return values.astype(index_dtype, copy=False)
+    return values
+
+
+def _flatten(column):
+    """Flattens a tree2array column of per-event arrays.
+
+    Returns (values, offsets) such that the values of event i are
+    values[offsets[i]:offsets[i+1]]. Columns holding one scalar per
+    event are returned as they are, with one value per event.
+    """
+    if column.dtype != np.object_:
+        return column, np.arange(len(column) + 1)
+    offsets = np.zeros(len(column) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter((len(item) for item in column), dtype=np.int64, count=len(column)), out=offsets[1:])
+    if len(column) == 0:
+        return np.empty(0), offsets
+    return np.concatenate(column), offsets
+
+
+##########
+class JaggedColumn(object):
+    """Class abstracting a column of variable-length rows, e.g. a vector<vector<>> branch.
+
+    The rows are stored flattened in compressed sparse row format: all
+    the values in one contiguous array, the values of row i being
+    values[offsets[i]:offsets[i+1]]. Lookups into other collections
+    (e.g. the rechits of the layer clusters) are then plain NumPy
+    fancy indexing over the flat values.
+    """
+
+    def __init__(self, values, offsets):
+        """Constructor.
+
+        Arguments:
+        values  -- Flat array of the values of all the rows
+        offsets -- int64 array of the row boundaries (length number of rows + 1)
+        """
+        super(JaggedColumn, self).__init__()
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def fromObjects(cls, objects, dtype=None):
+        """Returns the JaggedColumn of a sequence of per-row arrays (e.g. a getDataFrame() column)."""
+        offsets = _offsets([len(item) for item in objects])
+        if len(objects) == 0 or offsets[-1] == 0:
+            return cls(np.empty(0, dtype=dtype or np.int64), offsets)
+        return cls(np.concatenate([np.asarray(item, dtype=dtype) for item in objects]), offsets)
+
+    def __len__(self):
+        """Number of rows."""
+        return len(self.offsets) - 1
+
+    def row(self, index):
+        """Returns the values of a single row."""
+        return self.values[self.offsets[index]:self.offsets[index+1]]
+
+    def counts(self):
+        """Returns the number of values of each row."""
+        return np.diff(self.offsets)
+
+    def parents(self):
+        """Returns the row index of each of the flat values."""
+        return np.repeat(np.arange(len(self)), self.counts())
+
+    def select(self, rows):
+        """Returns the JaggedColumn of a subset of the rows, given by their indices."""
+        rows = np.asarray(rows, dtype=np.int64)
+        counts = self.counts()[rows]
+        offsets = _offsets(counts)
+        # position of each selected value in the flat array
+        positions = np.repeat(self.offsets[:-1][rows] - offsets[:-1], counts) + np.arange(offsets[-1])
+        return JaggedColumn(self.values[positions], offsets)
+
+    def gather(self, array):
+        """Returns the JaggedColumn of array[values], for columns holding indices into array."""
+        return JaggedColumn(np.asarray(array)[self.values], self.offsets)
+
+    def sum(self, weights=None):
+        """Returns the per-row sums of the values, or of weights (same length as values), in float64."""
+        if weights is None:
+            weights = self.values
+        return np.bincount(self.parents(), weights=weights, minlength=len(self))
+
+    def argmax(self, weights=None):
+        """Returns the flat position of the largest value (or weight) of each row, -1 for empty rows.
+
+        As for numpy.argmax, the first position is returned on ties. The
+        NaN values are skipped as by pandas idxmax, -1 being returned for
+        the rows holding only NaN values.
+        """
+        if weights is None:
+            weights = self.values
+        result = np.full(len(self), -1, dtype=np.int64)
+        if len(weights) == 0:
+            return result
+        parents = self.parents()
+        rowMax = np.full(len(self), -np.inf)
+        np.fmax.at(rowMax, parents, weights)
+        positions = np.flatnonzero(weights == rowMax[parents])
+        rows, first = np.unique(parents[positions], return_index=True)
+        result[rows] = positions[first]
+        return result
 
 
 ##########
@@ -166,35 +930,45 @@ class Event(object):
     or collections of objects.
     """
 
-    def __init__(self, tree, entry):
+    def __init__(self, tree, entry, schema=None, usedBranches=None):
         """Constructor.
 
         Arguments:
-        tree  -- TTree object
-        entry -- Entry number in the tree
+        tree         -- NtupleBackend object, or TTree object with the entry already loaded
+        entry        -- Entry number in the tree
+        schema       -- NtupleSchema of the tree (default: None, taken from the backend)
+        usedBranches -- Set in which the names of the accessed branches are recorded (default: None, no recording)
         """
         super(Event, self).__init__()
-        self._tree = tree
+        if not isinstance(tree, NtupleBackend):
+            tree = TreeBackend(tree)
+        self._backend = tree
         self._entry = entry
+        self._schema = schema
+        if schema is None:
+            self._schema = tree.schema()
+        self._usedBranches = usedBranches
+        # the objects read their branches through the per-entry cache
+        self._columns = _EventColumns(tree, entry, self._schema, usedBranches)
 
     def entry(self):
         return self._entry
 
     def event(self):
         """Returns event number."""
-        return self._tree.event
+        return self._columns.event
 
     def lumi(self):
         """Returns lumisection number."""
-        return self._tree.lumi
+        return self._columns.lumi
 
     def run(self):
         """Returns run number."""
-        return self._tree.run
+        return self._columns.run
 
     def eventId(self):
         """Returns (run, lumi, event) tuple."""
-        return (self._tree.run, self._tree.lumi, self._tree.event)
+        return (self.run(), self.lumi(), self.event())
 
     def eventIdStr(self):
         """Returns 'run:lumi:event' string."""
@@ -202,56 +976,689 @@ class Event(object):
 
     def genParticles(self, prefix="genpart"):
         """Returns generator particles object."""
-        return GenParticles(self._tree, prefix)
+        return GenParticles(self._columns, prefix)
 
     def primaryVertex(self, prefix="vtx"):
         """Returns PrimaryVertex object."""
-        return PrimaryVertex(self._tree, prefix)
+        return PrimaryVertex(self._columns, prefix)
 
     def recHits(self, prefix="rechit"):
         """Returns RecHits object."""
-        return RecHits(self._tree, prefix)
+        return RecHits(self._columns, prefix)
 
     def layerClusters(self, prefix="cluster2d"):
         """Returns LayerClusters object."""
-        return LayerClusters(self._tree, prefix)
+        return LayerClusters(self._columns, prefix)
 
     def multiClusters(self, prefix="multiclus"):
         """Returns MultiClusters object."""
-        return MultiClusters(self._tree, prefix)
+        return MultiClusters(self._columns, prefix)
 
     def simClusters(self, prefix="simcluster"):
         """Returns SimClusters object."""
-        return SimClusters(self._tree, prefix)
+        return SimClusters(self._columns, prefix)
 
     def pfClusters(self, prefix="pfcluster"):
         """Returns PFClusters object."""
-        return PFClusters(self._tree, prefix)
+        return PFClusters(self._columns, prefix)
 
     def pfClustersFromMultiCl(self, prefix="pfclusterFromMultiCl"):
         """Returns PFClusters object."""
-        return PFClusters(self._tree, prefix)
+        return PFClusters(self._columns, prefix)
 
     def caloParticles(self, prefix="calopart"):
         """Returns CaloParticles object."""
-        return CaloParticles(self._tree, prefix)
+        return CaloParticles(self._columns, prefix)
 
     def tracks(self, prefix="track"):
         """Returns Tracks object."""
-        return Tracks(self._tree, prefix)
+        return Tracks(self._columns, prefix)
 
     def electrons(self, prefix="ecalDrivenGsfele"):
         """Returns Electrons object."""
-        return Electrons(self._tree, prefix)
+        return Electrons(self._columns, prefix)
+
+    def getDataFrame(self, prefix, columns=None, float32=False, index_dtype=None):
+        """Returns the DataFrame of the objects of a prefix, one column per branch (<prefix>_<column>).
+
+        Arguments:
+        prefix      -- Branch prefix (e.g. 'rechit')
+        columns     -- List of the columns to read (default: None, all of them), the other branches are not read
+        float32     -- Store the double precision columns as float32 (default: False)
+        index_dtype -- NumPy type of the signed integer columns, including the index lists
+                       of the vector<vector<>> branches (default: None, type of the branch)
+        """
+        prefixSchema = self._schema.prefix(prefix)
+        if columns is not None:
+            prefixSchema = _project(prefixSchema, columns)
+        if self._usedBranches is not None:
+            self._usedBranches.update(prefixSchema.branches)
+        values = self._backend.read(prefixSchema.branches, self._entry, self._entry+1)
+        # build all the columns in one go, with the dtypes known from the schema
+        return _makeDataFrame([(name, np.asarray(values[branch][0], dtype=dtype))
+                               for branch, name, dtype in zip(*prefixSchema)],
+                              float32, index_dtype)
+
+    def getJaggedColumn(self, prefix, name):
+        """Returns the JaggedColumn of a vector<vector<>> branch (<prefix>_<name>), one row per object.
+
+        E.g. getJaggedColumn("cluster2d", "rechits").gather(energies)
+        gives the rechit energies of each layer cluster.
+        """
+        branch = prefix + "_" + name
+        if self._usedBranches is not None:
+            self._usedBranches.add(branch)
+        return self._backend.readJagged(branch, self._entry, self._entry+1)
+
+    def join(self, links, prefix, attrs=(), linkAttrs=(), rows=None):
+        """Follows a chain of index branches down to a child collection, for all the parents at once.
+
+        E.g. join([("multiclus", "cluster2d"), ("cluster2d", "rechits")], "rechit", ["energy"])
+        gives the energies of the rechits of all the multiclusters, with
+        for each of them the multicluster and the layer cluster it comes from.
+
+        Arguments:
+        links     -- List of (prefix, name) of the vector<vector<>> index branches (<prefix>_<name>) to follow
+        prefix    -- Prefix of the child collection the last link points to
+        attrs     -- List of member variables of the child collection (<prefix>_<attr>) to return
+        linkAttrs -- List of vector<vector<>> branches parallel to the last link (e.g. 'fractions') to return
+        rows      -- Indices of the parents in the first collection to start from (default: None, all of them)
+
+        Returns an OrderedDict of flat arrays, one value per child: the
+        index in each of the collections along the chain, keyed by their
+        prefix, then the requested linkAttrs and attributes keyed by name.
+        """
+        result = OrderedDict()
+        linkValues = OrderedDict()
+        current = rows
+        for level, (linkPrefix, name) in enumerate(links):
+            jagged = self.getJaggedColumn(linkPrefix, name)
+            if current is None:
+                current = np.arange(len(jagged))
+            result[linkPrefix] = np.asarray(current, dtype=np.int64)
+            children = jagged.select(current)
+            parents = children.parents()
+            for key in result:
+                result[key] = result[key][parents]
+            if level == len(links) - 1:
+                for linkAttr in linkAttrs:
+                    linkValues[linkAttr] = self.getJaggedColumn(linkPrefix, linkAttr).select(current).values
+            current = children.values
+        result[prefix] = np.asarray(current, dtype=np.int64)
+        result.update(linkValues)
+        for attr in attrs:
+            result[attr] = np.asarray(getattr(self._columns, prefix + "_" + attr))[result[prefix]]
+        return result
+
+    def multiClusterRecHits(self, attrs=(), prefix="multiclus"):
+        """Returns the rechits of all the multiclusters through their layer clusters, see join()."""
+        return self.join([(prefix, "cluster2d"), ("cluster2d", "rechits")], "rechit", attrs)
+
+    def electronRecHits(self, attrs=(), prefix="ecalDrivenGsfele"):
+        """Returns the rechits of all the electrons through their PFClusters, with their fractions, see join()."""
+        return self.join([(prefix, "pfClusterIndex"), ("pfclusterFromMultiCl", "rechits")], "rechit", attrs,
+                         linkAttrs=["fractions"])
+
+
+class _EventColumns(object):
+    """Adaptor caching the branches of the current entry.
+
+    Each branch is read from the backend the first time it is accessed,
+    as a NumPy array (a list of NumPy arrays for the vector<vector<>>
+    branches), which is then stored as an attribute, so that the
+    following accesses are plain attribute lookups. Branches of other
+    types are cached as returned by PyROOT.
+    """
+
+    def __init__(self, backend, entry, schema, usedBranches=None):
+        """Constructor.
+
+        Arguments:
+        backend      -- NtupleBackend object, with the entry already loaded
+        entry        -- Entry number
+        schema       -- NtupleSchema of the backend
+        usedBranches -- Set in which the names of the accessed branches are recorded (default: None, no recording)
+        """
+        super(_EventColumns, self).__init__()
+        self._backend = backend
+        self._entry = entry
+        self._schema = schema
+        self._usedBranches = usedBranches
+
+    def __getattr__(self, attr):
+        typeName = self._schema.typeName(attr)
+        if typeName is None:
+            raise AttributeError("no branch %s in the tree" % attr)
+        value = self._backend.value(attr, self._entry)
+        if self._usedBranches is not None:
+            self._usedBranches.add(attr)
+        setattr(self, attr, value)
+        return value
+
+
+# NumPy types of the std::vector branches
+_vectorTypes = {
+    "vector<float>": np.float32,
+    "vector<double>": np.float64,
+    "vector<int>": np.int32,
+    "vector<unsigned int>": np.uint32,
+    "vector<short>": np.int16,
+    "vector<unsigned short>": np.uint16,
+    "vector<long>": np.int64,
+    "vector<unsigned long>": np.uint64,
+    "vector<bool>": np.bool_,
+}
+
+
+# NumPy types of the branches holding a single number per event
+_leafTypes = {
+    "Float_t": np.float32,
+    "Double_t": np.float64,
+    "Int_t": np.int32,
+    "UInt_t": np.uint32,
+    "Short_t": np.int16,
+    "UShort_t": np.uint16,
+    "Long64_t": np.int64,
+    "ULong64_t": np.uint64,
+    "Bool_t": np.bool_,
+}
+
+
+def _dtype(typeName):
+    """Returns the NumPy dtype of the values of a branch of type typeName."""
+    return np.dtype(_vectorTypes.get(typeName) or _leafTypes.get(typeName) or np.object_)
+
+
+def _innerTypeName(typeName):
+    """Returns the type name of the elements of a vector<vector<>> type."""
+    return typeName[len("vector<"):].rstrip("> ") + ">"
+
+
+def _valueType(typeName):
+    """Returns the NumPy type of the single numbers held by a branch of type typeName.
+
+    Returns None for the types which cannot be stored as plain numbers.
+    """
+    if typeName.startswith("vector<vector<"):
+        return _vectorTypes.get(_innerTypeName(typeName))
+    return _vectorTypes.get(typeName) or _leafTypes.get(typeName)
+
+
+def _depth(typeName):
+    """Returns the nesting depth of a branch type: 0 for one number per event,
+    1 for std::vector and 2 for vector<vector<>>."""
+    if typeName.startswith("vector<vector<"):
+        return 2
+    if typeName.startswith("vector<"):
+        return 1
+    return 0
+
+
+def _toNumpy(value, className):
+    """Converts the PyROOT value of a branch of class className."""
+    if className.startswith("vector<vector<"):
+        innerType = _vectorTypes.get(_innerTypeName(className))
+        if innerType is not None:
+            return [np.array(item, dtype=innerType) for item in value]
+    elif className in _vectorTypes:
+        return np.array(value, dtype=_vectorTypes[className])
+    return value
+
+
+##########
+class NtupleBackend(object):
+    """Base class of the sources the events are read from.
+
+    A backend knows the branches of the ntuple (its NtupleSchema), the
+    number of entries, and returns the values of the branches either
+    for a single entry or for a range of entries. The implementations
+    are TreeBackend for the ROOT TTree/TChain, ColumnarStore for the
+    on-disk columnar copies and MemoryBackend for in-memory arrays.
+    """
+
+    def schema(self):
+        """Returns the NtupleSchema of the branches."""
+        raise NotImplementedError
+
+    def entries(self):
+        """Returns the number of entries."""
+        raise NotImplementedError
+
+    def branches(self):
+        """Returns the names of the branches."""
+        return self.schema().branches()
+
+    def load(self, entry):
+        """Prepares the reading of a single entry with value(), returns false if it cannot be read."""
+        return 0 <= entry < self.entries()
+
+    def value(self, branch, entry):
+        """Returns the value of a branch for a single entry, loaded with load().
+
+        This is a plain number for the branches with one number per event,
+        an array for the std::vector branches and a list of arrays for
+        the vector<vector<>> ones.
+        """
+        raise NotImplementedError
+
+    def read(self, branches, start, stop):
+        """Reads the entries [start, stop) of some branches.
+
+        Arguments:
+        branches -- List of branch names
+        start    -- First entry
+        stop     -- Entry following the last one
+
+        Returns an OrderedDict of (values, offsets) pairs keyed by branch
+        name, as returned by _flatten(): the values of the i-th entry are
+        values[offsets[i]:offsets[i+1]], vector<vector<>> branches giving
+        an object array of per-object arrays.
+        """
+        raise NotImplementedError
+
+    def sizes(self, branch, start, stop):
+        """Returns the number of values of a branch for each of the entries [start, stop)."""
+        return np.diff(self.read([branch], start, stop)[branch][1])
+
+    def readJagged(self, branch, start, stop):
+        """Returns the JaggedColumn of the objects of a vector<vector<>> branch in the entries [start, stop)."""
+        return JaggedColumn.fromObjects(self.read([branch], start, stop)[branch][0],
+                                        _valueType(self.schema().typeName(branch)))
+
+    def setBranchStatus(self, pattern, status):
+        """Enables (status 1) or disables (status 0) the reading of the branches matching pattern.
+
+        Only meaningful for the TTree, the other backends read the
+        branches only when they are accessed.
+        """
+        pass
+
+    def enableThreads(self):
+        """Prepares the backend to be read in a background thread while the main thread goes on, see iterate_chunks()."""
+        pass
+
+    def file(self):
+        """Returns the currently loaded ROOT file, if any."""
+        return None
+
+    def ioTimes(self):
+        """Returns the (wall, CPU) time in seconds spent in reading, if measured, and whether
+        some of it was spent outside of the main thread (see _Stopwatch)."""
+        return (0., 0., False)
+
+
+class TreeBackend(NtupleBackend):
+    """Backend reading a TTree (or TChain) with PyROOT and root_numpy."""
+
+    def __init__(self, tree):
+        """Constructor.
+
+        Arguments:
+        tree -- TTree object
+        """
+        super(TreeBackend, self).__init__()
+        self._tree = tree
+        self._schema = NtupleSchema.fromTree(tree)
+        self._stopwatch = _Stopwatch()
+
+    @classmethod
+    def fromFiles(cls, fileNames, tree="ana/hgc", cacheSize=30000000, learnEntries=10, threads=0):
+        """Returns the backend of the TChain of the trees of several files, see HGCalNtuple."""
+        if ROOT is None:
+            raise ImportError("PyROOT and root_numpy are required to read ROOT files with the TreeBackend, "
+                              "the ColumnarStore and MemoryBackend can be read without them")
+        if threads > 0 and not ROOT.ROOT.IsImplicitMTEnabled():
+            ROOT.ROOT.EnableImplicitMT(threads)
+        chain = ROOT.TChain(tree)
+        for name in fileNames:
+            chain.Add(name)
+        if cacheSize > 0:
+            chain.SetCacheSize(cacheSize)
+            chain.SetCacheLearnEntries(learnEntries)
+        if threads > 0:
+            # branches read in parallel by GetEntry() and tree2array, baskets decompressed in parallel
+            chain.SetImplicitMT(True)
+            chain.SetParallelUnzip(True)
+        return cls(chain)
+
+    def tree(self):
+        return self._tree
+
+    def schema(self):
+        return self._schema
+
+    def entries(self):
+        return self._tree.GetEntries()
+
+    def load(self, entry):
+        with self._stopwatch:
+            # get the tree of the entry in the chain and copy the entry into memory
+            if self._tree.LoadTree(entry) < 0:
+                return False
+            return self._tree.GetEntry(entry) > 0
+
+    def value(self, branch, entry):
+        return _toNumpy(getattr(self._tree, branch), self._schema.typeName(branch))
+
+    def read(self, branches, start, stop):
+        with self._stopwatch:
+            nd_array = rnp.tree2array(self._tree, branches=list(branches), start=start, stop=stop)
+        return OrderedDict((branch, _flatten(nd_array[branch])) for branch in branches)
+
+    def setBranchStatus(self, pattern, status):
+        self._tree.SetBranchStatus(pattern, status)
+
+    def enableThreads(self):
+        # tree2array runs in the background thread while the main thread may call PyROOT
+        ROOT.ROOT.EnableThreadSafety()
+
+    def file(self):
+        return self._tree.GetCurrentFile()
+
+    def ioTimes(self):
+        return self._stopwatch.times()
+
+
+class _Stopwatch(object):
+    """Context manager accumulating the wall and CPU (user + system, all threads) time of its blocks.
+
+    The blocks can run in several threads. The CPU time of the process
+    then includes the work of the other threads, so the blocks run
+    outside of the main thread are recorded ('shared').
+    """
+
+    def __init__(self):
+        super(_Stopwatch, self).__init__()
+        self.wall = 0.
+        self.cpu = 0.
+        self.shared = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __enter__(self):
+        self._local.start = (time.time(), _cpuTime())
+        return self
+
+    def __exit__(self, *args):
+        wall = time.time() - self._local.start[0]
+        cpu = _cpuTime() - self._local.start[1]
+        self.add(wall, cpu, threading.current_thread() is not _mainThread)
+        return False
+
+    def add(self, wall, cpu, shared=False):
+        """Adds the times measured elsewhere, e.g. in a worker process."""
+        with self._lock:
+            self.wall += wall
+            self.cpu += cpu
+            self.shared = self.shared or shared
+
+    def times(self):
+        """Returns the (wall, CPU) time in seconds and whether some blocks ran outside of the main thread."""
+        with self._lock:
+            return (self.wall, self.cpu, self.shared)
+
+
+# thread in which the module was imported, taken as the main thread of the process
+_mainThread = threading.current_thread()
+
+
+def _cpuTime():
+    times = os.times()
+    return times[0] + times[1]
+
+
+class _FlatBackend(NtupleBackend):
+    """Base class of the backends holding each branch as flat arrays.
+
+    All the numbers of a branch are held in one contiguous array
+    ('values'). The std::vector branches have per-event offsets
+    ('offsets', int64), the values of entry i being found at
+    [offsets[i]:offsets[i+1]], and the vector<vector<>> branches have
+    in addition per-object offsets ('inner', int64).
+    """
+
+    def _array(self, branch, kind):
+        """Returns the array of a branch, kind being 'values', 'offsets' or 'inner'."""
+        raise NotImplementedError
+
+    def value(self, branch, entry):
+        values = self._array(branch, "values")
+        depth = _depth(self.schema().typeName(branch))
+        if depth == 0:
+            return values[entry].item()
+        offsets = self._array(branch, "offsets")
+        if depth == 1:
+            return values[offsets[entry]:offsets[entry+1]]
+        inner = self._array(branch, "inner")
+        return [values[inner[index]:inner[index+1]] for index in range(offsets[entry], offsets[entry+1])]
+
+    def read(self, branches, start, stop):
+        columns = OrderedDict()
+        for branch in branches:
+            values = self._array(branch, "values")
+            depth = _depth(self.schema().typeName(branch))
+            if depth == 0:
+                columns[branch] = (values[start:stop], np.arange(stop - start + 1))
+                continue
+            offsets = self._array(branch, "offsets")[start:stop+1]
+            if depth == 1:
+                columns[branch] = (values[offsets[0]:offsets[-1]], offsets - offsets[0])
+                continue
+            inner = self._array(branch, "inner")
+            objects = np.empty(offsets[-1] - offsets[0], dtype=np.object_)
+            for index in range(len(objects)):
+                objects[index] = values[inner[offsets[0]+index]:inner[offsets[0]+index+1]]
+            columns[branch] = (objects, offsets - offsets[0])
+        return columns
+
+    def readJagged(self, branch, start, stop):
+        offsets = self._array(branch, "offsets")
+        inner = self._array(branch, "inner")[offsets[start]:offsets[stop]+1]
+        return JaggedColumn(self._array(branch, "values")[inner[0]:inner[-1]], inner - inner[0])
+
+    def sizes(self, branch, start, stop):
+        if _depth(self.schema().typeName(branch)) == 0:
+            return np.ones(stop - start, dtype=np.int64)
+        return np.diff(self._array(branch, "offsets")[start:stop+1])
+
+
+##########
+class ColumnarStore(_FlatBackend):
+    """Class abstracting an on-disk columnar copy of an ntuple.
+
+    The store is a directory holding a schema.json file and, for each
+    branch, the flat arrays described in _FlatBackend as binary files:
+    <branch>.values, <branch>.offsets and <branch>.inner.
+
+    The files are opened with np.memmap when first accessed, so that
+    reading the store only pages in the columns actually used. Only
+    the branches holding plain numbers can be stored.
+    """
+
+    schemaFileName = "schema.json"
+
+    def __init__(self, directory):
+        """Constructor.
+
+        Arguments:
+        directory -- Path to the directory of the store
+        """
+        super(ColumnarStore, self).__init__()
+        with open(os.path.join(directory, self.schemaFileName)) as schemaFile:
+            meta = json.load(schemaFile)
+        self._directory = directory
+        self._entries = meta["entries"]
+        self._schema = NtupleSchema([(str(branch), str(typeName)) for branch, typeName in meta["branches"]])
+        self._arrays = {}
+
+    @classmethod
+    def isStore(cls, path):
+        """Returns true if path is the directory of a ColumnarStore."""
+        return os.path.isfile(os.path.join(path, cls.schemaFileName))
+
+    def entries(self):
+        return self._entries
+
+    def schema(self):
+        return self._schema
+
+    def _array(self, branch, kind):
+        key = (branch, kind)
+        if key not in self._arrays:
+            dtype = np.int64
+            if kind == "values":
+                dtype = _valueType(self._schema.typeName(branch))
+            path = os.path.join(self._directory, "%s.%s" % (branch, kind))
+            if os.path.getsize(path) == 0:
+                self._arrays[key] = np.empty(0, dtype=dtype)  # np.memmap cannot map empty files
+            else:
+                self._arrays[key] = np.memmap(path, dtype=dtype, mode="r")
+        return self._arrays[key]
+
+    @classmethod
+    def write(cls, ntuple, directory, prefixes=None, chunk_size=100):
+        """Writes the branches of an ntuple into a new store.
+
+        The event id branches are always written, together with the
+        branches of the given prefixes. Branches which do not hold plain
+        numbers (e.g. vector<ROOT::Math::XYZPoint>) are skipped.
+
+        Arguments:
+        ntuple     -- HGCalNtuple object
+        directory  -- Path to the directory of the store, created if needed
+        prefixes   -- List of branch prefixes to write (default: None, all of them)
+        chunk_size -- Number of events read at a time (default: 100)
+        """
+        schema = ntuple.schema()
+        if prefixes is None:
+            prefixes = schema.prefixes()
+        branches = [branch for branch in HGCalNtuple.eventIdBranches if schema.hasBranch(branch)]
+        branches += [branch for prefix in prefixes for branch in schema.prefix(prefix).branches
+                     if _valueType(schema.typeName(branch)) is not None]
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # running number of values and of objects written for each branch
+        nValues = dict((branch, 0) for branch in branches)
+        nObjects = dict((branch, 0) for branch in branches)
+        files = {}
+        try:
+            for branch in branches:
+                depth = _depth(schema.typeName(branch))
+                for kind in ["values", "offsets", "inner"][:depth+1]:
+                    files[(branch, kind)] = open(os.path.join(directory, "%s.%s" % (branch, kind)), "wb")
+                    if kind != "values":
+                        np.zeros(1, dtype=np.int64).tofile(files[(branch, kind)])
+            for start in range(0, ntuple.nevents(), chunk_size):
+                stop = min(start + chunk_size, ntuple.nevents())
+                for branch, (values, offsets) in ntuple.backend().read(branches, start, stop).items():
+                    typeName = schema.typeName(branch)
+                    depth = _depth(typeName)
+                    if depth == 2:
+                        lengths = np.fromiter((len(item) for item in values), dtype=np.int64, count=len(values))
+                        (np.cumsum(lengths) + nValues[branch]).tofile(files[(branch, "inner")])
+                        values = np.concatenate(values) if len(values) > 0 else np.empty(0)
+                    if depth == 1:
+                        (offsets[1:] + nValues[branch]).astype(np.int64).tofile(files[(branch, "offsets")])
+                    elif depth == 2:
+                        (offsets[1:] + nObjects[branch]).astype(np.int64).tofile(files[(branch, "offsets")])
+                        nObjects[branch] += offsets[-1]
+                    np.asarray(values, dtype=_valueType(typeName)).tofile(files[(branch, "values")])
+                    nValues[branch] += len(values)
+        finally:
+            for openFile in files.values():
+                openFile.close()
+        # written last, so that an interrupted conversion does not look like a store
+        with open(os.path.join(directory, cls.schemaFileName), "w") as schemaFile:
+            json.dump({"entries": ntuple.nevents(),
+                       "branches": [[branch, schema.typeName(branch)] for branch in branches]},
+                      schemaFile, indent=1)
+
+
+##########
+class MemoryBackend(_FlatBackend):
+    """Backend holding the branches in memory, as NumPy arrays.
+
+    Allows to build synthetic events, e.g. to test or benchmark the
+    clustering and matching code without ROOT.
+    """
+
+    def __init__(self, columns, typeNames=None):
+        """Constructor.
+
+        Arguments:
+        columns   -- Dictionary of the per-event values of the branches, keyed by branch name:
+                     numbers for the branches with one number per event, sequences of numbers
+                     for the std::vector ones and sequences of sequences for the vector<vector<>> ones
+        typeNames -- Dictionary of the type names of the branches (default: None, guessed from the values)
+        """
+        super(MemoryBackend, self).__init__()
+        if typeNames is None:
+            typeNames = {}
+        self._arrays = {}
+        self._entries = None
+        branchTypes = []
+        for branch in sorted(columns):
+            events = columns[branch]
+            typeName = typeNames.get(branch) or _guessTypeName(events)
+            if self._entries is None:
+                self._entries = len(events)
+            elif len(events) != self._entries:
+                raise ValueError("branch %s has %d entries instead of %d" % (branch, len(events), self._entries))
+            depth = _depth(typeName)
+            if depth == 0:
+                self._arrays[(branch, "values")] = np.asarray(events, dtype=_valueType(typeName))
+            else:
+                self._arrays[(branch, "offsets")] = _offsets([len(event) for event in events])
+                objects = events
+                if depth == 2:
+                    objects = [item for event in events for item in event]
+                    self._arrays[(branch, "inner")] = _offsets([len(item) for item in objects])
+                self._arrays[(branch, "values")] = np.array([number for item in objects for number in item],
+                                                            dtype=_valueType(typeName))
+            branchTypes.append((branch, typeName))
+        self._schema = NtupleSchema(branchTypes)
+        if self._entries is None:
+            self._entries = 0
+
+    def entries(self):
+        return self._entries
+
+    def schema(self):
+        return self._schema
+
+    def _array(self, branch, kind):
+        return self._arrays[(branch, kind)]
+
+
+def _offsets(lengths):
+    """Returns the int64 offsets of consecutive blocks of the given lengths."""
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def _isSequence(value):
+    return isinstance(value, (list, tuple, np.ndarray))
+
+
+def _guessTypeName(events):
+    """Returns the type name of a branch from its per-event values, see MemoryBackend."""
+    numbers = list(events)
+    depth = 0
+    while depth < 2 and any(_isSequence(number) for number in numbers):
+        numbers = [number for item in numbers for number in item]
+        depth += 1
+    dtype = np.asarray(numbers).dtype if len(numbers) > 0 else np.dtype(np.float32)
+    if depth == 0:
+        names = [name for name, leafType in _leafTypes.items() if np.dtype(leafType) == dtype]
+    else:
+        names = [name for name, vectorType in _vectorTypes.items() if np.dtype(vectorType) == dtype]
+    if len(names) == 0:
+        raise ValueError("cannot store values of type %s" % dtype)
+    if depth == 2:
+        return "vector<%s >" % names[0]
+    return names[0]
 
-    def getDataFrame(self, prefix):
-        branches = [br.GetName() for br in self._tree.GetListOfBranches() if br.GetName().startswith(prefix+'_')]
-        names = [br.split('_')[1] for br in branches]
-        nd_array = rnp.tree2array(self._tree, branches=branches, start=self._entry, stop=self._entry+1)
-        df = pd.DataFrame()
-        for idx in range(0, len(branches)):
-            df[names[idx]] = nd_array[branches[idx]][0]
-        return df
 
 ##########
 class PrimaryVertex(object):
@@ -324,7 +1731,7 @@ class GenParticle(_Object):
 
     def _nExtrapolatedLayers(self):
         """Internal function to get the number of layers through which the particle was extrapolated."""
-        return self._tree.genpart_posx[self._index].size()
+        return len(self._tree.genpart_posx[self._index])
 
     def nExtrapolatedLayers(self):
         """Returns the number of layers through which the particle was extrapolated."""
@@ -2,7 +2,7 @@
 # import ROOT
 # import os
 import optparse
-from NtupleDataFormat import HGCalNtuple
+from NtupleDataFormat import HGCalNtuple, JaggedColumn
 import hgcalHelpers
 import numpy as np
 import pandas as pd
@@ -89,6 +89,13 @@ class SACevent:
 				print "Layer number %d: Si energy sum = %f, Sci energy sum = %f" %(l,h.si_sumen[l],h.sci_sumen[l])
 
 
+def reachedEESelection(chunk):
+    """cut for HGCalNtuple.build_selection: events with a genParticle reaching the endcap
+    without nuclear interaction in the tracker, the others have no matched hit sums"""
+    genParticles = chunk.columns("genpart")
+    selected = (genParticles["reachedEE"] != 0) & (genParticles["gen"] >= 0)
+    return JaggedColumn(selected, chunk.offsets("genpart")).sum() > 0
+
 
 def main():
     global opt, args
@@ -101,6 +108,7 @@ def main():
     parser.add_option('', '--gunType', dest='gunType', type='string',  default='pt', help='pt or e')
     parser.add_option('', '--pid', dest='pid', type='int',  default=211, help='pdgId int')
     parser.add_option('', '--genValue', dest='genValue', type='float',  default=25, help='generated pT or energy')
+    parser.add_option('', '--preselect', dest='preselect', action='store_true', default=False, help='only read the events with a genpart reaching the endcap, the entries being stored for later runs')
 
     # store options and arguments as global variables
     global opt, args
@@ -110,6 +118,7 @@ def main():
     print "gunType:", opt.gunType
     print "pid:", opt.pid
     print "GEN_engpt:", opt.genValue
+    print "preselect:", opt.preselect
 
     # set sample/tree - for photons
     gun_type = opt.gunType
@@ -118,14 +127,19 @@ def main():
 
     fileList = opt.fileString.split(",")
 
-    for fileName in fileList:
-        ntuple = HGCalNtuple(opt.fileString)
-
-        for event in ntuple:
-            if (event.entry() > 11):
-                break
-            SACEvt = SACevent(event,60)
-            SACEvt.Print()
+    ntuple = HGCalNtuple(fileList)
+    if opt.preselect:
+        # skip the events without genParticle reaching the endcap, the entries are stored for later runs
+        try:
+            ntuple.loadSelection("reachedEE")
+        except (IOError, ValueError):
+            ntuple.build_selection("reachedEE", reachedEESelection)
+
+    for event in ntuple:
+        if (event.entry() > 11):
+            break
+        SACEvt = SACevent(event,60)
+        SACEvt.Print()
 
 
 if __name__ == '__main__':
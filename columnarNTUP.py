@@ -0,0 +1,28 @@
+import os
+import sys
+
+from NtupleDataFormat import HGCalNtuple
+
+chunkSize = 500
+
+
+def convertFile(outDir, fileName):
+
+    # one store per ROOT file, named after it
+    storeName = os.path.join(outDir, os.path.basename(fileName).replace(".root", ""))
+    print("Converting {} into {}".format(fileName, storeName))
+
+    ntuple = HGCalNtuple(fileName)
+    ntuple.writeColumnarStore(storeName, chunk_size=chunkSize)
+
+
+def main():
+
+    # usage: python columnarNTUP.py outDir file1.root [file2.root ...]
+    outDir = sys.argv[1]
+    for rootFile in sys.argv[2:]:
+        convertFile(outDir, rootFile)
+
+
+if __name__ == '__main__':
+    main()
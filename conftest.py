@@ -0,0 +1,2 @@
+# pytest puts the directory of this file on sys.path, so that the tests import the modules of the
+# repository (HGCalImagingAlgo, NtupleDataFormat, ...) also when run with a plain "pytest"
@@ -1,5 +1,5 @@
 import numpy as np
-from HGCalImagingAlgo import recHitAboveThreshold
+from HGCalImagingAlgo import recHitsAboveThreshold
 import math
 from scipy.spatial import cKDTree
 import pandas
@@ -32,6 +32,8 @@ def getRecHitsSimAssoc(rechits_raw, simcluster, dependSensor=True, ecut=3, verbo
     nSimClus = 0
     simClusHitAssoc = []
     recHitDetIds = getRecHitDetIds(rechits_raw)
+    # energy treshold of all the rechits at once
+    aboveThreshold = recHitsAboveThreshold(rechits_raw, ecut, dependSensor)[1]
     for simClusIndex, simClus in enumerate(simcluster):
         simClusHitAssoc.append(getHitList(simClus, recHitDetIds))
         nSimClus += 1
@@ -44,9 +46,9 @@ def getRecHitsSimAssoc(rechits_raw, simcluster, dependSensor=True, ecut=3, verbo
         rHitsSimAssocTemp = []
         for hitIndexArray in simClusHitAssoc[simClusIndex]:
             for hitIndex in hitIndexArray:
-                thisHit = rechits_raw[hitIndex]
-                if(not recHitAboveThreshold(thisHit, ecut, dependSensor)[1]):
+                if(not aboveThreshold[hitIndex]):
                     continue
+                thisHit = rechits_raw[hitIndex]
                 # independent of sim cluster, after cleaning
                 rHitsSimAssocTemp.append(thisHit)
         rHitsSimAssoc[simClusIndex] = rHitsSimAssocTemp
@@ -45,6 +45,8 @@ def getRecHitsSimAssoc(rechits_raw, simcluster):
     nSimClus = 0
     simClusHitAssoc = []
     recHitDetIds = getRecHitDetIds(rechits_raw)
+    # energy treshold of all the rechits at once
+    aboveThreshold = recHitsAboveThreshold(rechits_raw, ecut, dependSensor)[1]
     for simClusIndex, simClus in enumerate(simcluster):
         simClusHitAssoc.append(getHitList(simClus, recHitDetIds))
         nSimClus += 1
@@ -56,8 +58,8 @@ def getRecHitsSimAssoc(rechits_raw, simcluster):
         rHitsSimAssocTemp = []
         for hitIndexArray in simClusHitAssoc[simClusIndex]:
             for hitIndex in hitIndexArray:
+                if(not aboveThreshold[hitIndex]): continue
                 thisHit = rechits_raw[hitIndex]
-                if(not recHitAboveTreshold(thisHit, ecut, dependSensor)[1]): continue
                 # independent of sim cluster, after cleaning
                 rHitsSimAssocTemp.append(thisHit)
         rHitsSimAssoc[simClusIndex]= rHitsSimAssocTemp
@@ -196,6 +198,10 @@ def main():
     clusters2D_eng_rerun = []
     clusters2DMultiSelected_eng_rerun = []
 
+    # instantiate the stand-alone clustering implemented in HGCalImagingAlgo (once, it has no per-event state)
+    # (for many small events, HGCalAlgo.clusterEvents() clusters the rechits of a chunk of events at once)
+    HGCalAlgo = HGCalImagingAlgo(ecut = ecut, deltac = deltac, multiclusterRadii = multiclusterRadii, minClusters = minClusters, dependSensor = dependSensor, verbosityLevel = 0)
+
     # start event loop
     for event in ntuple:
         if (not event.entry() in allowedRangeEvents): continue # checking external condition
@@ -210,7 +216,7 @@ def main():
         # get flat list of rechist associated to sim-cluster hits
         rHitsSimAssoc = getRecHitsSimAssoc(recHitsRaw, simClusters)
         # get flat list of raw rechits which satisfy treshold condition
-        rHitsCleaned = [rechit for rechit in recHitsRaw if recHitAboveTreshold(rechit, ecut, dependSensor)[1]]
+        rHitsCleaned = [rechit for rechit, above in zip(recHitsRaw, recHitsAboveThreshold(recHitsRaw, ecut, dependSensor)[1]) if above]
 
         ### Imaging algo run at RECO step (CMSSW)
         # get flat list of all clusters 2D produced with algo at RECO step (CMSSW)
@@ -219,16 +225,13 @@ def main():
         multiClustersList_reco = [multiCluster for multiCluster in multiClusters]
 
         ### Imaging algo run as stand-alone (python)
-        # instantiate the stand-alone clustering implemented in HGCalImagingAlgo
-        HGCalAlgo = HGCalImagingAlgo(ecut = ecut, deltac = deltac, multiclusterRadii = multiclusterRadii, minClusters = minClusters, dependSensor = dependSensor, verbosityLevel = 0)
         # produce 2D clusters with stand-alone algo, out of all raw rechits
-        clusters2D_rerun = HGCalAlgo.makeClusters(recHitsRaw) # nested list of "hexels", per layer, per 2D cluster
+        hexels_rerun, clusters2DTable_rerun = HGCalAlgo.makeClusters(recHitsRaw, flat = True) # per-hit arrays (HitStore) and table of 2D clusters
         # produce multi-clusters with stand-alone algo, out of all 2D clusters
-        multiClustersList_rerun = HGCalAlgo.make3DClusters(clusters2D_rerun) # flat list of multi-clusters (as basic clusters)
+        multiClustersTable_rerun, multiClusterIndex_rerun = HGCalAlgo.make3DClusters(clusters2DTable_rerun) # table of multi-clusters, and multi-cluster of each 2D cluster
 
-        # get for testing: flat list of 2D clustered, and flat list of clustered non-halo "hexeles" (from stand-alone algo)
-        clusters2DList_rerun = HGCalAlgo.getClusters(clusters2D_rerun, verbosityLevel = 0) # flat list of 2D clusters (as basic clusters)
-        hexelsClustered_rerun = [iNode for bClust in clusters2DList_rerun for iNode in bClust.thisCluster if not iNode.isHalo]  # flat list of clustered "hexeles", without the "halo" hexels
+        # get for testing: clustered non-halo "hexeles" (from stand-alone algo)
+        clustered_rerun = (hexels_rerun.clusterIndex != -1) & ~hexels_rerun.isHalo # mask of the clustered hits, without the "halo" hexels
 
         ### Produce some basic histograms for each event (2D/3D view of associated sim-clusters, selected rec-hits, etc.)
         if (verbosityLevel>=2):
@@ -237,11 +240,12 @@ def main():
             # histograming of raw rechist (with ecut cleaning)
             histDict = histRecHits(rHitsCleaned, event.entry(), histDict, tag = "rHitsCleaned_", zoomed = True)
             # histograming of clustered hexels
+            hexelsClustered_rerun = [HexelView(hexels_rerun, i) for i in np.flatnonzero(clustered_rerun).tolist()]
             histDict = histHexelsClustered(hexelsClustered_rerun, event.entry(), histDict, tag = "clustHex_", zoomed = False)
 
         ### Compare stand-alone clustering and sim-clusters
         rHitsSimAssocDID = [rechit.detid() for simClus in rHitsSimAssoc for rechit in simClus] # list of detids for sim-associated rehits (with ecut cleaning)
-        rHitsClustdDID = [iNode.detid for iNode in hexelsClustered_rerun] # list of detids for clustered hexels
+        rHitsClustdDID = hexels_rerun.detid[clustered_rerun].tolist() # list of detids for clustered hexels
         # print some info if requested
         if (verbosityLevel>=1):
             print( "num of rechits associated with sim-clusters : ", len (rHitsSimAssocDID))
@@ -250,25 +254,24 @@ def main():
             print( "num of sim-associated not found in clustered:", len(list(set(rHitsSimAssocDID )-set(rHitsClustdDID))))
 
         ### Compare stand-alone and reco-level clustering
-        clusters2DListMultiSelected_rerun = [cls for multiCluster in multiClustersList_rerun for cls in multiCluster.thisCluster]
+        nClusters2DMultiSelected_rerun = int(np.count_nonzero(multiClusterIndex_rerun != -1)) # number of 2D clusters in multi-clusters
         # print more details if requested
         if (verbosityLevel>=1):
-            ls = sorted(range(len(clusters2DListMultiSelected_rerun)), key=lambda k: clusters2DListMultiSelected_rerun[k].thisCluster[0].layer, reverse=False) # indices sorted by increasing layer number
-            for index in range(len(multiClustersList_rerun)): print( "Multi-cluster (RE-RUN) index: ", index, ", No. of 2D-clusters = ", len(multiClustersList_rerun[index].thisCluster), ", Energy  = ", multiClustersList_rerun[index].energy, ", Phi = ", multiClustersList_rerun[index].phi, ", Eta = ", multiClustersList_rerun[index].eta, ", z = ", multiClustersList_rerun[index].z )
+            for index in range(len(multiClustersTable_rerun)): print( "Multi-cluster (RE-RUN) index: ", index, ", No. of 2D-clusters = ", multiClustersTable_rerun.nClusters[index], ", Energy  = ", multiClustersTable_rerun.energy[index], ", Phi = ", multiClustersTable_rerun.phi[index], ", Eta = ", multiClustersTable_rerun.eta[index], ", z = ", multiClustersTable_rerun.z[index] )
             ls = sorted(range(len(clusters2DList_reco)), key=lambda k: clusters2DList_reco[k].layer(), reverse=False) # indices sorted by increasing layer number
             for index in range(len(multiClustersList_reco)): print( "Multi-cluster (RECO) index: ", index, ", No. of 2D-clusters = ", len(multiClustersList_reco[index].cluster2d()), ", Energy  = ", multiClustersList_reco[index].energy(), ", Phi = ", multiClustersList_reco[index].phi(), ", Eta = ", multiClustersList_reco[index].eta(), ", z = ", multiClustersList_reco[index].z())
             print( "num of clusters2D @reco : ", len(clusters2DList_reco))
-            print( "num of clusters2D re-run: ", len(clusters2DListMultiSelected_rerun))
+            print( "num of clusters2D re-run: ", nClusters2DMultiSelected_rerun)
             print( "num of multi-cluster @reco : ", len(multiClustersList_reco))
-            print( "num of multi-cluster re-run: ", len(multiClustersList_rerun))
+            print( "num of multi-cluster re-run: ", len(multiClustersTable_rerun))
 
         ### Produce some basic histograms with general info (one per sample)
         if (verbosityLevel>=2):
             # relative diff. in number of 2D clusters (re-run vs. reco)
-            multiClusters_nClust2DDiff.append(100*float(len(clusters2DListMultiSelected_rerun) - len(clusters2DList_reco))/float(len(clusters2DList_reco)))
+            multiClusters_nClust2DDiff.append(100*float(nClusters2DMultiSelected_rerun - len(clusters2DList_reco))/float(len(clusters2DList_reco)))
             # number of 2D clusters from algo at re-run step
-            tot_nClust2D_rerun.append(len(clusters2DListMultiSelected_rerun))
-            clusters2D_eng_rerun.extend([clusters2DList_rerun[k].energy for k in range(0,len(clusters2DList_rerun))]) # eng re-run
+            tot_nClust2D_rerun.append(nClusters2DMultiSelected_rerun)
+            clusters2D_eng_rerun.extend(clusters2DTable_rerun.energy.tolist()) # eng re-run
             # number of 2D clusters from algo at RECO step
             tot_nClust2D_reco.append(len(clusters2DList_reco))
             clusters2D_eng_reco.extend([clusters2DList_reco[k].energy() for k in range(0,len(clusters2DList_reco))]) # eng reco
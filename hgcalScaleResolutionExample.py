@@ -37,6 +37,8 @@ def getRecHitsSimAssoc(rechits_raw, simcluster):
     nSimClus = 0
     simClusHitAssoc = []
     recHitDetIds = getRecHitDetIds(rechits_raw)
+    # energy treshold of all the rechits at once
+    aboveThreshold = recHitsAboveThreshold(rechits_raw, ecut, dependSensor)[1]
     for simClusIndex, simClus in enumerate(simcluster):
         simClusHitAssoc.append(getHitList(simClus, recHitDetIds))
         nSimClus += 1
@@ -48,8 +50,8 @@ def getRecHitsSimAssoc(rechits_raw, simcluster):
         rHitsSimAssocTemp = []
         for hitIndexArray in simClusHitAssoc[simClusIndex]:
             for hitIndex in hitIndexArray:
+                if(not aboveThreshold[hitIndex]): continue
                 thisHit = rechits_raw[hitIndex]
-                if(not recHitAboveTreshold(thisHit, ecut, dependSensor)[1]): continue
                 # independent of sim cluster, after cleaning
                 rHitsSimAssocTemp.append(thisHit)
         rHitsSimAssoc[simClusIndex]= rHitsSimAssocTemp
@@ -460,21 +462,23 @@ def runCalibrationScaleResolution(pidSelected, GEN_eng, ntuple, relFractionE):
         simClusters_energyAboveThreshold = []
         simClusters_energyAboveThresholdContained = []
         simClusters_energyAll = []
+        # energy treshold of the associated rechits, for each sim-cluster
+        rHitsSimAssocAbove = [recHitsAboveThreshold(rHitsSimAssoc[k], ecut, dependSensor)[1] for k in range(len(simClusters))]
         # store the rechit info
-        hitsSelected.extend([(10*rechit.x(), 10*rechit.y(), rechit.energy(), recHitAboveTreshold(rechit, ecut, dependSensor)[1]) for k in range(len(simClusters)) for rechit in rHitsSimAssoc[k]])
+        hitsSelected.extend([(10*rechit.x(), 10*rechit.y(), rechit.energy(), above) for k in range(len(simClusters)) for rechit, above in zip(rHitsSimAssoc[k], rHitsSimAssocAbove[k])])
         # store in list the energy with filtering of simi hits
         for k in range(len(simClusters)):
             sum_simHitsEnergyAll = 0
             sum_simHitsEnergyAbove = 0
             sum_simHitsEnergyContained = 0
-            for rechit in rHitsSimAssoc[k]:
+            for rechit, above in zip(rHitsSimAssoc[k], rHitsSimAssocAbove[k]):
                 # energy for rechits above noise
                 sum_simHitsEnergyAll += rechit.energy()
                 # energy for rechits above noise
-                if recHitAboveTreshold(rechit, ecut, dependSensor)[1]:
+                if above:
                     sum_simHitsEnergyAbove += rechit.energy()
                 # energy of rechits above noise and after masking
-                if (recHitAboveTreshold(rechit, ecut, dependSensor)[1] and (rechit.layer()>35 or (rechit.layer()<=35 and gu.planes[rechit.layer()-1].contains(10*rechit.x(), 10*rechit.y())))):
+                if (above and (rechit.layer()>35 or (rechit.layer()<=35 and gu.planes[rechit.layer()-1].contains(10*rechit.x(), 10*rechit.y())))):
                     sum_simHitsEnergyContained += rechit.energy()
             simClusters_energyAll.append(sum_simHitsEnergyAll)
             simClusters_energyAboveThreshold.append(sum_simHitsEnergyAbove)
@@ -1,4 +1,5 @@
 import ROOT
+import numpy as np
 from math import cos, cosh, sqrt, ceil
 from NtupleDataFormat import *
 from glob import glob
@@ -94,6 +95,9 @@ def analysePFClustersFromMultiCl(ntuple):
 def analyseElectronsRecHits(ntuple):
 #    ev = ntuple.getEvent(1)
   for ev in ntuple:
+    # rechits of all the electrons, through their PFClusters, in one go
+    hits = ev.electronRecHits(["layer", "x", "y", "energy"])
+    hits_weight = (hits["energy"]*hits["fractions"]).astype(np.float64)
     for e in ev.electrons():
       if e.isEB(): continue
       print("SC Position: ({x}, {y}, {z}) eta: {eta}, phi: {phi}, energy: {energy}".format(
@@ -104,12 +108,16 @@ def analyseElectronsRecHits(ntuple):
       for c in e.clustersFromMultiCl():
         print c
         h_mustache.Fill(e.seedphi()-c.phi(), e.seedeta()-c.eta())
-        for i, rh in enumerate(c.hits()):
-          if rh.layer() <= 28:
-            h_rechits[rh.layer()].Fill(rh.x(), rh.y(), rh.energy()*c.fractions()[i])
         if e.seedlayer() <=28:
           h_sc[e.seedlayer()].Fill(e.scpos().x(), e.scpos().y(), e.energy())
           h_seed[e.seedlayer()].Fill(e.seedpos().x(), e.seedpos().y(), e.seedenergy())
+      selected = (hits["ecalDrivenGsfele"] == e.index()) & (hits["layer"] <= 28)
+      for layer in np.unique(hits["layer"][selected]):
+        in_layer = selected & (hits["layer"] == layer)
+        h_rechits[int(layer)].FillN(int(in_layer.sum()),
+                                    hits["x"][in_layer].astype(np.float64),
+                                    hits["y"][in_layer].astype(np.float64),
+                                    hits_weight[in_layer])
       return
 
 def ZeeAnalyses(ntuple):
@@ -4,7 +4,7 @@
 import optparse
 # from array import array
 # from HGCalImagingAlgo import recHitAboveThreshold
-from NtupleDataFormat import HGCalNtuple
+from NtupleDataFormat import HGCalNtuple, JaggedColumn
 # from GeoUtils import GeoUtil
 # import math
 import hgcalHelpers
@@ -24,11 +24,9 @@ def getConeRadius(frontRadius, backRadius, z, maxval=9999.):
     return val
 
 
-def pileupSubtraction(matchedMultiCluster, selectedLayerClusters, recHits, layer, energyRadius, frontRadius, backRadius):
+def pileupSubtraction(matchedMultiCluster, selectedLayerClusters, layerClusterHits, recHits, layer, energyRadius, frontRadius, backRadius):
     """For now, the code is the same as in getMegaClusters, but the phi coordinate is changed by pi."""
 
-    pTSum = 0
-    energySum = 0
     # take first layer cluster z value
     layer_z = selectedLayerClusters.head(1).z.item()
     # get multi cluster x and y coordinates
@@ -41,26 +39,47 @@ def pileupSubtraction(matchedMultiCluster, selectedLayerClusters, recHits, layer
     # mind that we need only the first index since there is only one multiCluster
     layerClusterIndices = hgcalHelpers.getIndicesWithinRadius(multiClusPosDF[['x', 'y']], selectedLayerClusters[['x', 'y']], coneRadius)
     # now we need to recalculate the layer cluster energies using associated RecHits
-    for layerClusterIndex in layerClusterIndices[0]:
-        associatedRecHits = recHits.iloc[selectedLayerClusters.iloc[layerClusterIndex].rechits]
-        # find maximum energy RecHit
-        maxEnergyRecHitIndex = associatedRecHits['energy'].argmax()
-        # considering only associated RecHits within a radius of energyRadius (6 cm)
-        matchedRecHitIndices = hgcalHelpers.getIndicesWithinRadius(associatedRecHits.loc[[maxEnergyRecHitIndex]][['x', 'y']], associatedRecHits[['x', 'y']], energyRadius)[maxEnergyRecHitIndex]
-        # sum up energies and pT
-        selectedRecHits = associatedRecHits.iloc[matchedRecHitIndices]
-        # correct energy by subdetector weights
-        energySum += selectedRecHits[["energy"]].sum()[0]*energyWeights[layer-1]*1.38
-        pTSum += selectedRecHits[["pt"]].sum()[0]*energyWeights[layer-1]*1.38
+    # sum up energies and pT of the RecHits around the maximum energy RecHit of each layer cluster
+    clusterHits = layerClusterHits.select(selectedLayerClusters.index.values[layerClusterIndices[0]])
+    (energySum, pTSum) = sumAroundMaxRecHits(clusterHits, recHits, energyRadius)
+    # correct energy by subdetector weights
+    energySum *= energyWeights[layer-1]*1.38
+    pTSum *= energyWeights[layer-1]*1.38
 
     return (energySum, pTSum)
 
 
-def getMegaClusters(genParticles, multiClusters, layerClusters, recHits, gun_type, GEN_engpt, pidSelected, energyRadius=6, frontRadius=3, backRadius=8, doPileupSubtraction=True):
+def sumAroundMaxRecHits(clusterHits, recHits, energyRadius):
+    """
+    sum up the energy and pT of the RecHits of layer clusters
+    which are within energyRadius of the maximum energy RecHit of their cluster.
+    clusterHits: JaggedColumn of the RecHit indices of the layer clusters
+    returns (energySum, pTSum)
+    """
+    hitIndices = clusterHits.values
+    if len(hitIndices) == 0:
+        return (0., 0.)
+    hitEnergies = recHits.energy.values[hitIndices]
+    # distances computed in float64, as the cKDTree query did
+    hitX = recHits.x.values[hitIndices].astype(np.float64)
+    hitY = recHits.y.values[hitIndices].astype(np.float64)
+    # find maximum energy RecHit of each layer cluster, skipping the clusters without one (all energies NaN)
+    maxHits = clusterHits.argmax(hitEnergies)[clusterHits.parents()]
+    hasMax = maxHits != -1
+    # considering only associated RecHits within a radius of energyRadius (6 cm)
+    selected = np.zeros(len(hitIndices), dtype=bool)
+    selected[hasMax] = (hitX[hasMax] - hitX[maxHits[hasMax]])**2 + (hitY[hasMax] - hitY[maxHits[hasMax]])**2 <= energyRadius*energyRadius
+    energySum = hitEnergies[selected].sum(dtype=np.float64)
+    pTSum = recHits.pt.values[hitIndices][selected].sum(dtype=np.float64)
+    return (energySum, pTSum)
+
+
+def getMegaClusters(genParticles, multiClusters, layerClusters, recHits, gun_type, GEN_engpt, pidSelected, energyRadius=6, frontRadius=3, backRadius=8, doPileupSubtraction=True, layerClusterHits=None):
     """
     get the actual mega clusters.
     frontRadius: cone at front of EE
     backRadius: cone at back of FH (frontRadius to be added to it)
+    layerClusterHits: JaggedColumn of the RecHit indices of the layer clusters, built from layerClusters.rechits if not given
     returns a dataframe containing 4-vectors
     """
 
@@ -82,6 +101,8 @@ def getMegaClusters(genParticles, multiClusters, layerClusters, recHits, gun_typ
         bestMultiClusterIndices = hgcalHelpers.getHighestEnergyObjectIndex(selectedGen[['eta', 'phi']], multiClusters[['eta', 'phi']], multiClusters['energy'], 0.1)
     # print bestMultiClusterIndices
 
+    if layerClusterHits is None:
+        layerClusterHits = JaggedColumn.fromObjects(layerClusters.rechits.values)
     megaClusters = []
 
     for idx, genPart in selectedGen.iterrows():
@@ -108,19 +129,13 @@ def getMegaClusters(genParticles, multiClusters, layerClusters, recHits, gun_typ
             # mind that we need only the first index since there is only one multiCluster
             layerClusterIndices = hgcalHelpers.getIndicesWithinRadius(multiClusPosDF[['x', 'y']], selectedLayerClusters[['x', 'y']], coneRadius)
             # now we need to recalculate the layer cluster energies using associated RecHits
-            for layerClusterIndex in layerClusterIndices[0]:
-                associatedRecHits = recHits.iloc[selectedLayerClusters.iloc[layerClusterIndex].rechits]
-                # find maximum energy RecHit
-                maxEnergyRecHitIndex = associatedRecHits['energy'].argmax()
-                # considering only associated RecHits within a radius of energyRadius (6 cm)
-                matchedRecHitIndices = hgcalHelpers.getIndicesWithinRadius(associatedRecHits.loc[[maxEnergyRecHitIndex]][['x', 'y']], associatedRecHits[['x', 'y']], energyRadius)[maxEnergyRecHitIndex]
-                # sum up energies and pT
-                selectedRecHits = associatedRecHits.iloc[matchedRecHitIndices]
-                # correct energy by subdetector weights
-                energySum += selectedRecHits[["energy"]].sum()[0]*energyWeights[layer-1]*1.38
-                pTSum += selectedRecHits[["pt"]].sum()[0]*energyWeights[layer-1]*1.38
+            clusterHits = layerClusterHits.select(selectedLayerClusters.index.values[layerClusterIndices[0]])
+            (layerEnergySum, layerPTSum) = sumAroundMaxRecHits(clusterHits, recHits, energyRadius)
+            # correct energy by subdetector weights
+            energySum += layerEnergySum*energyWeights[layer-1]*1.38
+            pTSum += layerPTSum*energyWeights[layer-1]*1.38
             if (doPileupSubtraction):
-                (pu_energySum, pu_pTSum) = pileupSubtraction(matchedMultiCluster, selectedLayerClusters, recHits, layer, energyRadius, frontRadius, backRadius)
+                (pu_energySum, pu_pTSum) = pileupSubtraction(matchedMultiCluster, selectedLayerClusters, layerClusterHits, recHits, layer, energyRadius, frontRadius, backRadius)
                 energySum -= pu_energySum
                 pTSum -= pu_pTSum
 
@@ -138,10 +153,11 @@ def getCollections(event):
     get the collections to be fed to the mega clustering.
     need genParticles, multiClusters, layerClusters, recHits
     """
-    genParticles = event.getDataFrame(prefix="genpart")
-    multiClusters = event.getDataFrame(prefix="multiclus")
-    layerClusters = event.getDataFrame(prefix="cluster2d")
-    recHits = event.getDataFrame(prefix="rechit")
+    # only the columns used by getMegaClusters, in compact types
+    genParticles = event.getDataFrame(prefix="genpart", columns=["pid", "reachedEE", "pt", "energy", "eta", "phi"], float32=True)
+    multiClusters = event.getDataFrame(prefix="multiclus", columns=["eta", "phi", "energy"], float32=True)
+    layerClusters = event.getDataFrame(prefix="cluster2d", columns=["layer", "eta", "x", "y", "z", "rechits"], float32=True, index_dtype=np.int32)
+    recHits = event.getDataFrame(prefix="rechit", columns=["x", "y", "energy", "pt"], float32=True)
     return genParticles, multiClusters, layerClusters, recHits
 
 
@@ -174,16 +190,15 @@ def main():
 
     fileList = opt.fileString.split(",")
 
-    for fileName in fileList:
-        ntuple = HGCalNtuple(opt.fileString)
+    ntuple = HGCalNtuple(fileList)
 
-        for event in ntuple:
-            if (event.entry() > 11):
-                break
-            # get collections
-            genParticles, multiClusters, layerClusters, recHits = getCollections(event)
-            megaClusters = getMegaClusters(genParticles, multiClusters, layerClusters, recHits, gun_type, GEN_engpt, pidSelected)
-            print megaClusters
+    for event in ntuple:
+        if (event.entry() > 11):
+            break
+        # get collections
+        genParticles, multiClusters, layerClusters, recHits = getCollections(event)
+        megaClusters = getMegaClusters(genParticles, multiClusters, layerClusters, recHits, gun_type, GEN_engpt, pidSelected)
+        print megaClusters
 
 
 if __name__ == '__main__':
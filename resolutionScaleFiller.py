@@ -4,13 +4,15 @@ import os
 import optparse
 # from array import array
 # from HGCalImagingAlgo import recHitAboveThreshold
-from NtupleDataFormat import HGCalNtuple
+from NtupleDataFormat import HGCalNtuple, JaggedColumn
 # from GeoUtils import GeoUtil
 import math
 import hgcalHelpers
 import hgcalHistHelpers
 import numpy as np
 import timeit
+import functools
+import operator
 import megaClustering
 
 # filtering parameters
@@ -80,9 +82,21 @@ class ResolutionScaleObject:
         return (self.dPt() / self.refTLV.Pt())
 
 
-def eventLoop(ntuple, refName, objName, gun_type, pidOfInterest, GEN_engpt, histDict):
+def getPrefixes(refName, objName):
+    """prefixes of the branches needed for the reference and object collections"""
+    if (objName == "megacluster"):
+        objPrefixes = ["genpart", "multiclus", "cluster2d", "rechit"]
+    elif (objName == "pfcluster_uncalib"):
+        objPrefixes = ["pfcluster"]
+    else:
+        objPrefixes = [objName]
+    return [refName] + [prefix for prefix in objPrefixes if prefix != refName]
+
+
+def eventLoop(ntuple, refName, objName, gun_type, pidOfInterest, GEN_engpt, histDict, chunkSize=50, workers=1, prefetch=0):
     """
-    Loop over ntuple,
+    Loop over ntuple, split in blocks of events processed by the given number of worker processes,
+    each reading prefetch chunks ahead in the background if requested,
     for the collection of interest, match with genPart to select relevant objects,
     then pass selected objects to calculate scale and resolution
     """
@@ -90,51 +104,79 @@ def eventLoop(ntuple, refName, objName, gun_type, pidOfInterest, GEN_engpt, hist
     GEN_pTEng = "{0}={1:.1f} GeV".format(gun_type, GEN_engpt)
     GEN_partId = pidmap[pidOfInterest]
 
-    # define some global lists and dictionaries
-    # obj_Eng_EngRelDiff = {pid: [] for pid in s_all_pids}
-    resolutionScaleObjects = []
-
     # initialisation of GeoUtils
     # gu = GeoUtil()
 
     # loop over the events
     print "Total events to process (PID:", GEN_partId, ",", GEN_pTEng, "):", ntuple.nevents()
-    # for event in ntuple:
-    for event in ntuple:
-        # if (event.entry() > 10):
-            # break
-        if (verbosityLevel >= 0):
-            if (event.entry() % 1 == 0):
-                print "Event: ", event.entry()
-        # get collections
-        referenceCollection = event.getDataFrame(prefix=refName)
-        collectionOfInterest = None
-        if (objName == "megacluster"):
-            genParticles, multiClusters, layerClusters, recHits = megaClustering.getCollections(event)
-            collectionOfInterest = megaClustering.getMegaClusters(genParticles, multiClusters, layerClusters, recHits, gun_type, GEN_engpt, pidOfInterest)
-        elif (objName == "pfcluster_uncalib"):
-            # use normal pfcluster collection, but in the following energy instead of correctedEnergy will be used
-            collectionOfInterest = event.getDataFrame(prefix="pfcluster")
-        else:
-            collectionOfInterest = event.getDataFrame(prefix=objName)
-        # print "collections:", len(collectionOfInterest), len(referenceCollection)
-        # filter reference Collection for faster matching
-        if collectionOfInterest.shape[0] == 0:
-            # continue of no collectionOfInterest entries
-            continue
-        if (gun_type == "e"):
-            referenceCollection = filterReferenceCollection(referenceCollection, pidOfInterest, refMinE=GEN_engpt*.999)
-        else:
-            referenceCollection = filterReferenceCollection(referenceCollection, pidOfInterest, refMinPt=GEN_engpt*.999)
-        if referenceCollection.shape[0] == 0:
-            # continue of no referenceCollection entries
-            continue
-
-        pairs = getReferencePairs(referenceCollection, collectionOfInterest, objName)
-        resolutionScaleObjects += getResolutionScaleObjects(pairs, objName)
+    processBlock = functools.partial(processEvents, refName=refName, objName=objName, gun_type=gun_type,
+                                     pidOfInterest=pidOfInterest, GEN_engpt=GEN_engpt, chunkSize=chunkSize,
+                                     prefetch=prefetch)
+    resolutionScaleObjects = ntuple.map_reduce(processBlock, operator.add, workers)
     fillComparisonHistograms(resolutionScaleObjects, GEN_engpt, histDict)
 
 
+def processEvents(ntuple, start, stop, refName, objName, gun_type, pidOfInterest, GEN_engpt, chunkSize=50, prefetch=0):
+    """
+    Loop over the entries [start, stop) of the ntuple, reading chunkSize events at a time
+    (prefetch chunks ahead in a background thread if prefetch > 0),
+    return the list of ResolutionScaleObjects of the matched objects
+    """
+    # define some global lists and dictionaries
+    # obj_Eng_EngRelDiff = {pid: [] for pid in s_all_pids}
+    resolutionScaleObjects = []
+
+    for chunk in ntuple.iterate_chunks(getPrefixes(refName, objName), chunkSize, start, stop, prefetch):
+        for event in chunk:
+            # if (event.entry() > 10):
+                # break
+            if (verbosityLevel >= 0):
+                if (event.entry() % 1 == 0):
+                    print "Event: ", event.entry()
+            # get collections
+            referenceCollection = event.getDataFrame(prefix=refName)
+            collectionOfInterest = None
+            if (objName == "megacluster"):
+                genParticles, multiClusters, layerClusters, recHits = megaClustering.getCollections(event)
+                collectionOfInterest = megaClustering.getMegaClusters(genParticles, multiClusters, layerClusters, recHits, gun_type, GEN_engpt, pidOfInterest)
+            elif (objName == "pfcluster_uncalib"):
+                # use normal pfcluster collection, but in the following energy instead of correctedEnergy will be used
+                collectionOfInterest = event.getDataFrame(prefix="pfcluster")
+            else:
+                collectionOfInterest = event.getDataFrame(prefix=objName)
+            # print "collections:", len(collectionOfInterest), len(referenceCollection)
+            # filter reference Collection for faster matching
+            if collectionOfInterest.shape[0] == 0:
+                # continue of no collectionOfInterest entries
+                continue
+            if (gun_type == "e"):
+                referenceCollection = filterReferenceCollection(referenceCollection, pidOfInterest, refMinE=GEN_engpt*.999)
+            else:
+                referenceCollection = filterReferenceCollection(referenceCollection, pidOfInterest, refMinPt=GEN_engpt*.999)
+            if referenceCollection.shape[0] == 0:
+                # continue of no referenceCollection entries
+                continue
+
+            pairs = getReferencePairs(referenceCollection, collectionOfInterest, objName)
+            resolutionScaleObjects += getResolutionScaleObjects(pairs, objName)
+    return resolutionScaleObjects
+
+
+def referenceSelection(pidOfInterest, refMinPt=0, refMinE=0):
+    """return a cut for HGCalNtuple.build_selection, keeping the events
+    with at least one genpart passing filterReferenceCollection"""
+
+    def cut(chunk):
+        genParticles = chunk.columns("genpart")
+        selected = (abs(genParticles["pid"]) == pidOfInterest) & (genParticles["reachedEE"] > 0)
+        if refMinPt > 0:
+            selected &= genParticles["pt"] > refMinPt
+        if refMinE > 0:
+            selected &= genParticles["energy"] > refMinE
+        return JaggedColumn(selected, chunk.offsets("genpart")).sum() > 0
+    return cut
+
+
 def filterReferenceCollection(referenceCollection, pidOfInterest, refMinPt=0, refMinE=0):
     """cut on reference pdgId and minPt or minE
     probably need a new function for other collections"""
@@ -264,6 +306,10 @@ def main():
     parser.add_option('', '--tag', dest='tag', type='string',  default='noPU', help='some tag, best used for PU and other info')
     parser.add_option('', '--ref', dest='refName', type='string',  default='genpart', help='reference collection')
     parser.add_option('', '--obj', dest='objName', type='string',  default='pfcluster', help='object of interest collection')
+    parser.add_option('', '--workers', dest='workers', type='int',  default=1, help='number of worker processes')
+    parser.add_option('', '--preselect', dest='preselect', action='store_true', default=False, help='only read the events with a selected genpart, the entries being stored for later runs')
+    parser.add_option('', '--threads', dest='threads', type='int',  default=0, help='number of threads used by ROOT to read the ntuple')
+    parser.add_option('', '--prefetch', dest='prefetch', type='int',  default=0, help='number of event chunks read ahead in the background')
 
     # store options and arguments as global variables
     global opt, args
@@ -275,6 +321,9 @@ def main():
     print "GEN_engpt:", opt.genValue
     print "refName:", opt.refName
     print "objName:", opt.objName
+    print "workers:", opt.workers
+    print "prefetch:", opt.prefetch
+    print "threads:", opt.threads
 
     # set sample/tree - for photons
     gun_type = opt.gunType
@@ -289,9 +338,20 @@ def main():
 
     start_time = timeit.default_timer()
 
-    for fileName in fileList:
-        ntuple = HGCalNtuple(opt.fileString)
-        eventLoop(ntuple, refName, objName, gun_type, pidSelected, GEN_engpt, histDict)
+    ntuple = HGCalNtuple(fileList, threads=opt.threads)
+    if opt.preselect and refName == "genpart":
+        selectionName = "{}_{}_{}GeV".format(gun_type, pidSelected, GEN_engpt)
+        try:
+            ntuple.loadSelection(selectionName)
+        except (IOError, ValueError):
+            if gun_type == "e":
+                cut = referenceSelection(pidSelected, refMinE=GEN_engpt*.999)
+            else:
+                cut = referenceSelection(pidSelected, refMinPt=GEN_engpt*.999)
+            ntuple.build_selection(selectionName, cut)
+        print "selected events:", len(ntuple.selection())
+    eventLoop(ntuple, refName, objName, gun_type, pidSelected, GEN_engpt, histDict, workers=opt.workers, prefetch=opt.prefetch)
+    print ntuple.ioReport()
 
     f = ROOT.TFile("{}_{}_{}GeV_{}_{}_{}.root".format(gun_type, pidSelected, GEN_engpt, refName, objName, tag), "recreate")
     for etaBinName in etaBins:
@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+import HGCalImagingAlgo
+
+
+class RecHit(object):
+
+    def __init__(self, layer, thickness, energy):
+        self._layer = layer
+        self._thickness = thickness
+        self._energy = energy
+
+    def layer(self):
+        return self._layer
+
+    def thickness(self):
+        return self._thickness
+
+    def energy(self):
+        return self._energy
+
+
+def test_aboveThreshold_layer_without_noise():
+    # layers beyond the noise table (and negative ones) are never above the threshold
+    sigmaNoise, above = HGCalImagingAlgo.aboveThreshold([60, 1, -1], [300., 300., 300.], [1., 1., 1.], 3, True)
+    assert above.tolist() == [False, True, False]
+    assert np.isnan(sigmaNoise[0]) and np.isnan(sigmaNoise[2])
+    assert sigmaNoise[1] == HGCalImagingAlgo.sigmaNoiseTable()[1, 2]
+    # without dependSensor the layer does not matter
+    assert HGCalImagingAlgo.aboveThreshold([60], [300.], [4.], 3, False)[1].tolist() == [True]
+
+
+def test_recHitAboveThreshold_layer_without_noise():
+    assert not HGCalImagingAlgo.recHitAboveThreshold(RecHit(60, 300., 1.), 3)[1]
+    assert HGCalImagingAlgo.recHitAboveThreshold(RecHit(1, 300., 1.), 3)[1]
+
+
+def referenceDistanceToHigher(x, y, rho):
+    # the original double loop over the hits sorted by decreasing density
+    rs = sorted(range(len(x)), key=lambda k: rho[k], reverse=True)
+    delta, nearestHigher = [0.] * len(x), [-1] * len(x)
+    max_dist2 = max(pow(x[j] - x[rs[0]], 2) + pow(y[j] - y[rs[0]], 2) for j in range(len(x)))
+    delta[rs[0]] = pow(max_dist2, 0.5)
+    for oi in range(1, len(x)):
+        dist2 = max_dist2
+        for oj in range(0, oi):
+            tmp = pow(x[rs[oj]] - x[rs[oi]], 2) + pow(y[rs[oj]] - y[rs[oi]], 2)
+            if(tmp <= dist2):
+                dist2 = tmp
+                nearestHigher[rs[oi]] = rs[oj]
+        delta[rs[oi]] = pow(dist2, 0.5)
+    return delta, nearestHigher
+
+
+@pytest.mark.parametrize("k", [(8, 64), (2,), (1000,)])
+def test_distanceToHigher_as_double_loop(k):
+    rng = np.random.RandomState(2)
+    # hits on a grid with few density values: ties of the densities and of the distances
+    x, y = np.round(rng.uniform(-5., 5., (2, 300)))
+    rho = rng.randint(0, 4, 300).astype(np.float64)
+    # the densest hit, 30 away from a group of 20 hits and far from a group of 100 hits: the densest hit of each
+    # group has the densest hit as nearest higher one, beyond the first kNN round (and the second one for the 100)
+    x = np.concatenate((x, [100.], rng.uniform(100., 101., 20), rng.uniform(-41., -40., 100)))
+    y = np.concatenate((y, [0.], rng.uniform(30., 31., 20), rng.uniform(0., 1., 100)))
+    rho = np.concatenate((rho, [10.], rng.uniform(4., 5., 20), rng.uniform(6., 7., 100)))
+    delta, nearestHigher = HGCalImagingAlgo.distanceToHigher(x, y, rho, k=k)
+    expectedDelta, expectedNearestHigher = referenceDistanceToHigher(x.tolist(), y.tolist(), rho.tolist())
+    assert nearestHigher == expectedNearestHigher
+    assert delta == expectedDelta
+    assert nearestHigher[300 + 1 + np.argmax(rho[301:321])] == 300
+    assert nearestHigher[300 + 21 + np.argmax(rho[321:])] == 300
+
+
+def test_clusterPositions_halo_only_nan_weight():
+    # halo-only clusters are at their most energetic hexel, the nan weights being skipped as in the hexel loop
+    labels = np.array([0, 0, 0, 1, 1, 2])
+    weight = np.array([np.nan, 2., 3., np.nan, np.nan, -2.])
+    x = np.array([1., 2., 3., 4., 5., 6.])
+    x_, y_, z_, energy = HGCalImagingAlgo.clusterPositionsByLabel(labels, 3, weight, x, x, x, np.ones(6, dtype=bool))
+    assert x_.tolist() == [3., 0., 0.]
+    assert energy.tolist() == [0., 0., 0.]
+
+
+def test_clusterSegments_as_makeLayerClusters():
+    # all the (event, layerID) segments clustered at once give the same hits as the segments one by one
+    rng = np.random.RandomState(1)
+    n = 3000
+    columns = {"x": np.round(rng.randn(n) * 6.), "y": np.round(rng.randn(n) * 6.), "layer": rng.randint(1, 53, n),
+               "energy": rng.exponential(0.3, n), "thickness": np.full(n, 300.)}
+    columns["z"] = np.where(rng.rand(n) < 0.5, -1., 1.) * (320. + columns["layer"])
+    for method in ("eta", "phi", "time", "detid", "cluster2d"):
+        columns[method] = np.zeros(n)
+    columns["isHalf"] = np.zeros(n, dtype=bool)
+    events = np.sort(rng.randint(0, 5, n))
+    algo = HGCalImagingAlgo.HGCalImagingAlgo(deltac=[2., 3., 5.])
+    nLayerIDs = 2 * (algo.maxlayer + 1)
+    hits = algo.populateColumns(columns, events=events, nEvents=5)
+    expected = algo.populateColumns(columns, events=events, nEvents=5)
+    algo.clusterSegments(hits)
+    for segment in range(len(expected.offsets) - 1):
+        if expected.offsets[segment + 1] > expected.offsets[segment]:
+            algo.makeLayerClusters(expected.layerHits(segment), segment % nLayerIDs)
+    assert (hits.clusterIndex != -1).any()
+    for name, dtype, value in HGCalImagingAlgo.HitStore.outputs:
+        assert np.array_equal(getattr(hits, name), getattr(expected, name)), name
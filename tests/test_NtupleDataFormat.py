@@ -0,0 +1,301 @@
+import warnings
+
+import numpy as np
+import pytest
+
+import NtupleDataFormat
+from NtupleDataFormat import ColumnarStore, HGCalNtuple, JaggedColumn, MemoryBackend
+
+nEvents = 12
+
+
+def makeColumns(seed=0):
+    # per-event values of a small ntuple: genparticles, rechits, layer clusters pointing to the rechits and
+    # multiclusters pointing to the layer clusters, the collections being sized by their <prefix>_pt branch
+    rng = np.random.RandomState(seed)
+    columns = dict((branch, []) for branch in ("run", "lumi", "event", "genpart_pt", "genpart_eta", "genpart_pid",
+                                               "rechit_pt", "rechit_energy", "rechit_layer", "cluster2d_pt",
+                                               "cluster2d_rechits", "multiclus_pt", "multiclus_cluster2d"))
+    for entry in range(nEvents):
+        nGen, nRecHits = rng.randint(0, 3), (0 if entry == 3 else rng.randint(1, 30))
+        nClusters = rng.randint(0, 6) if nRecHits > 0 else 0
+        columns["run"].append(1)
+        columns["lumi"].append(entry // 5)
+        columns["event"].append(100 + entry)
+        columns["genpart_pt"].append(rng.exponential(10., nGen).astype(np.float32))
+        columns["genpart_eta"].append(rng.uniform(-3., 3., nGen).astype(np.float32))
+        columns["genpart_pid"].append(rng.choice([11, 22, 211], nGen).astype(np.int32))
+        columns["rechit_pt"].append(rng.exponential(1., nRecHits).astype(np.float32))
+        columns["rechit_energy"].append(rng.exponential(1., nRecHits).astype(np.float32))
+        columns["rechit_layer"].append(rng.randint(1, 53, nRecHits).astype(np.int32))
+        columns["cluster2d_pt"].append(rng.exponential(1., nClusters).astype(np.float32))
+        columns["cluster2d_rechits"].append([rng.randint(0, nRecHits, rng.randint(0, 4)).astype(np.int32)
+                                             for cluster in range(nClusters)])
+        nMulti = rng.randint(0, 3) if nClusters > 0 else 0
+        columns["multiclus_pt"].append(rng.exponential(5., nMulti).astype(np.float32))
+        columns["multiclus_cluster2d"].append([rng.randint(0, nClusters, rng.randint(0, 3)).astype(np.int32)
+                                               for multi in range(nMulti)])
+    return columns
+
+
+def makeNtuple(columns=None):
+    return HGCalNtuple(MemoryBackend(makeColumns() if columns is None else columns))
+
+
+def assertSameFrame(frame, reference):
+    assert list(frame.columns) == list(reference.columns)
+    assert len(frame) == len(reference)
+    for name in frame.columns:
+        for value, expected in zip(frame[name].values, reference[name].values):
+            assert np.array_equal(value, expected), name
+
+
+def referenceFrame(columns, prefix, entry):
+    # DataFrame of an entry built from the per-event values
+    branches = sorted(branch for branch in columns if branch.startswith(prefix + "_"))
+    frame = {}
+    for branch in branches:
+        frame[branch[len(prefix) + 1:]] = list(columns[branch][entry])
+    return frame, [branch[len(prefix) + 1:] for branch in branches]
+
+
+def test_memoryBackend_schema_and_values():
+    columns = makeColumns()
+    ntuple = makeNtuple(columns)
+    schema = ntuple.schema()
+    assert ntuple.nevents() == nEvents
+    assert schema.typeName("run") == "Int_t" or schema.typeName("run") == "Long64_t"
+    assert schema.typeName("rechit_energy") == "vector<float>"
+    assert schema.typeName("cluster2d_rechits") == "vector<vector<int> >"
+    assert schema.prefixes() == ["cluster2d", "genpart", "multiclus", "rechit"]
+    for event in ntuple:
+        entry = event.entry()
+        assert event.eventId() == (1, entry // 5, 100 + entry)
+        frame = event.getDataFrame("rechit")
+        reference, names = referenceFrame(columns, "rechit", entry)
+        assert list(frame.columns) == names
+        for name in names:
+            assert frame[name].tolist() == [value.item() for value in reference[name]]
+        # the objects are sized by the <prefix>_pt branch
+        recHits = event.recHits()
+        assert len(recHits) == len(columns["rechit_pt"][entry])
+        assert [recHit.energy() for recHit in recHits] == columns["rechit_energy"][entry].tolist()
+        clusters = event.getDataFrame("cluster2d")
+        assert len(clusters) == len(event.layerClusters())
+        for value, expected in zip(clusters["rechits"], columns["cluster2d_rechits"][entry]):
+            assert np.array_equal(value, expected)
+    with pytest.raises(ValueError):
+        MemoryBackend({"run": [1, 2], "event": [1]})
+
+
+def test_treeBackend_without_root():
+    if NtupleDataFormat.ROOT is not None:
+        pytest.skip("PyROOT is available")
+    with pytest.raises(ImportError):
+        HGCalNtuple("ntuple.root")
+
+
+def test_columnarStore_write_round_trip(tmpdir):
+    ntuple = makeNtuple()
+    directory = str(tmpdir.join("store"))
+    ntuple.writeColumnarStore(directory, chunk_size=5)
+    assert ColumnarStore.isStore(directory)
+    stored = HGCalNtuple(directory)
+    assert stored.store() is not None and stored.tree() is None
+    assert stored.nevents() == ntuple.nevents()
+    assert sorted(stored.schema().branches()) == sorted(ntuple.schema().branches())
+    for event, storedEvent in zip(ntuple, stored):
+        assert event.eventId() == storedEvent.eventId()
+        for prefix in ntuple.schema().prefixes():
+            assertSameFrame(storedEvent.getDataFrame(prefix), event.getDataFrame(prefix))
+        jagged = storedEvent.getJaggedColumn("cluster2d", "rechits")
+        expected = event.getJaggedColumn("cluster2d", "rechits")
+        assert np.array_equal(jagged.values, expected.values) and np.array_equal(jagged.offsets, expected.offsets)
+    # a subset of the prefixes, the event id branches being always written
+    HGCalNtuple(MemoryBackend(makeColumns())).writeColumnarStore(str(tmpdir.join("rechits")), prefixes=["rechit"])
+    assert HGCalNtuple(str(tmpdir.join("rechits"))).schema().prefixes() == ["rechit"]
+    assert HGCalNtuple(str(tmpdir.join("rechits"))).schema().hasBranch("event")
+
+
+@pytest.mark.parametrize("prefetch", [0, 2])
+def test_iterate_chunks(prefetch):
+    ntuple = makeNtuple()
+    events = makeNtuple()  # read one by one, not while the chunks are prefetched from the other one
+    entries = []
+    for chunk in ntuple.iterate_chunks(["rechit", "cluster2d"], chunk_size=5, start=1, prefetch=prefetch):
+        assert len(chunk) == len(chunk.entries()) <= 5
+        for event in chunk:
+            entries.append(event.entry())
+            reference = events.getEvent(event.entry())
+            for prefix in ("rechit", "cluster2d"):
+                assertSameFrame(event.getDataFrame(prefix), reference.getDataFrame(prefix))
+            jagged = event.getJaggedColumn("cluster2d", "rechits")
+            assert np.array_equal(jagged.values, reference.getJaggedColumn("cluster2d", "rechits").values)
+        # the offsets of a prefix follow its <prefix>_pt branch
+        assert np.array_equal(np.diff(chunk.offsets("rechit")),
+                              [len(events.getEvent(entry).recHits()) for entry in chunk.entries()])
+    assert entries == list(range(1, nEvents))
+
+
+def test_iterate_chunks_prefetch_store_in_memory(tmpdir):
+    # the prefetching thread reads the memory-mapped columns of a store, instead of leaving it to the caller
+    directory = str(tmpdir.join("store"))
+    makeNtuple().writeColumnarStore(directory)
+    stored = HGCalNtuple(directory)
+    for prefetch in (0, 2):
+        for chunk in stored.iterate_chunks(["rechit", "cluster2d"], chunk_size=5, prefetch=prefetch):
+            assert isinstance(chunk.column("rechit", "energy"), np.memmap) == (prefetch == 0)
+            if prefetch > 0:
+                assert not any(isinstance(item, np.memmap) for item in chunk.column("cluster2d", "rechits"))
+    assert [chunk.column("rechit", "energy").tolist() for chunk in stored.iterate_chunks(["rechit"], 5, prefetch=2)] == \
+        [chunk.column("rechit", "energy").tolist() for chunk in stored.iterate_chunks(["rechit"], 5)]
+
+
+class FailingBackend(MemoryBackend):
+
+    def read(self, branches, start, stop):
+        if stop > 5:
+            raise IOError("cannot read entries %d to %d" % (start, stop))
+        return super(FailingBackend, self).read(branches, start, stop)
+
+
+def test_iterate_chunks_prefetch_error():
+    # an error of the reading thread is raised in the caller, after the chunks read before it
+    ntuple = HGCalNtuple(FailingBackend(makeColumns()))
+    chunks = []
+    with pytest.raises(IOError):
+        for chunk in ntuple.iterate_chunks(["rechit"], chunk_size=5, prefetch=2):
+            chunks.append(chunk.entries().tolist())
+    assert chunks == [list(range(5))]
+
+
+def test_getDataFrame_projection_and_dtypes():
+    ntuple = makeNtuple()
+    for event in ntuple:
+        full = event.getDataFrame("cluster2d")
+        frame = event.getDataFrame("cluster2d", columns=["rechits", "pt"])
+        assert list(frame.columns) == ["rechits", "pt"]
+        assertSameFrame(frame, full[["rechits", "pt"]])
+        compact = event.getDataFrame("cluster2d", columns=["rechits", "pt"], index_dtype=np.int16)
+        for value, expected in zip(compact["rechits"], full["rechits"]):
+            assert value.dtype == np.int16 and np.array_equal(value, expected)
+        recHits = event.getDataFrame("rechit", columns=["layer", "energy"], index_dtype=np.int16, float32=True)
+        assert recHits["layer"].dtype == np.int16 and recHits["energy"].dtype == np.float32
+        assert recHits["layer"].tolist() == event.getDataFrame("rechit")["layer"].tolist()
+    with pytest.raises(KeyError):
+        ntuple.getEvent(0).getDataFrame("rechit", columns=["nosuchcolumn"])
+
+
+def test_event_join():
+    columns = makeColumns()
+    ntuple = makeNtuple(columns)
+    for event in ntuple:
+        entry = event.entry()
+        joined = event.multiClusterRecHits(["energy"])
+        assert list(joined) == ["multiclus", "cluster2d", "rechit", "energy"]
+        # reference: loops over the multiclusters, their layer clusters and their rechits
+        expected = [(multi, cluster, recHit, columns["rechit_energy"][entry][recHit])
+                    for multi, clusters in enumerate(columns["multiclus_cluster2d"][entry])
+                    for cluster in clusters
+                    for recHit in columns["cluster2d_rechits"][entry][cluster]]
+        assert list(zip(*joined.values())) == expected
+        # starting from some of the parents only
+        if len(columns["multiclus_pt"][entry]) > 1:
+            subset = event.join([("multiclus", "cluster2d"), ("cluster2d", "rechits")], "rechit", rows=[1])
+            assert np.array_equal(subset["rechit"], joined["rechit"][joined["multiclus"] == 1])
+
+
+def test_jaggedColumn():
+    rows = [[3., 1., 3.], [], [2.], [-1., 5.]]
+    column = JaggedColumn.fromObjects([np.array(row) for row in rows])
+    assert len(column) == 4
+    assert column.counts().tolist() == [3, 0, 1, 2]
+    assert column.parents().tolist() == [0, 0, 0, 2, 3, 3]
+    assert [column.row(index).tolist() for index in range(4)] == rows
+    selected = column.select([3, 0])
+    assert [selected.row(index).tolist() for index in range(2)] == [rows[3], rows[0]]
+    assert column.sum().tolist() == [7., 0., 2., 4.]
+    # flat positions of the first maximum of each row, -1 for the empty ones
+    assert column.argmax().tolist() == [0, -1, 3, 5]
+    assert column.argmax(weights=-column.values).tolist() == [1, -1, 3, 4]
+    indices = JaggedColumn.fromObjects([np.array([2, 0]), np.array([1])])
+    assert [indices.gather(np.array([10., 20., 30.])).row(index).tolist() for index in range(2)] == [[30., 10.], [20.]]
+    assert len(JaggedColumn.fromObjects([])) == 0 and len(JaggedColumn.fromObjects([[], []]).values) == 0
+
+
+def test_jaggedColumn_argmax_nan():
+    # the NaN values are skipped, as by pandas idxmax
+    rows = [[1., np.nan, 3.], [np.nan, 2.], [np.nan, np.nan], [-np.inf, np.nan]]
+    column = JaggedColumn.fromObjects([np.array(row) for row in rows])
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        assert column.argmax().tolist() == [2, 4, -1, 7]
+
+
+def selectWithGenParticles(chunk):
+    return np.diff(chunk.offsets("genpart")) > 0
+
+
+def test_build_and_load_selection(tmpdir):
+    columns = makeColumns()
+    ntuple = makeNtuple(columns)
+    expected = [entry for entry in range(nEvents) if len(columns["genpart_pt"][entry]) > 0]
+    assert ntuple.build_selection("withGen", selectWithGenParticles, chunk_size=5, directory=str(tmpdir)).tolist() == expected
+    assert [event.entry() for event in ntuple] == expected
+
+    other = makeNtuple(columns)
+    assert other.loadSelection("withGen", directory=str(tmpdir)).tolist() == expected
+    chunkEntries = [entry for chunk in other.iterate_chunks(["rechit"], chunk_size=2) for entry in chunk.entries().tolist()]
+    assert chunkEntries == expected
+    # the selected events of the chunks are the ones read one by one
+    for chunk in other.iterate_chunks(["rechit"], chunk_size=3):
+        for event in chunk:
+            assertSameFrame(event.getDataFrame("rechit"), ntuple.getEvent(event.entry()).getDataFrame("rechit"))
+    assert other.selectedEntries(2, 8).tolist() == [entry for entry in expected if 2 <= entry < 8]
+    other.clearSelection()
+    assert len(list(other)) == nEvents
+
+    # a selection built for other inputs is refused
+    smaller = HGCalNtuple(MemoryBackend(dict((branch, values[:5]) for branch, values in columns.items())))
+    with pytest.raises(ValueError):
+        smaller.loadSelection("withGen", directory=str(tmpdir))
+
+
+def selectWithRecHits(chunk):
+    return np.diff(chunk.offsets("rechit")) > 0
+
+
+def test_selections_of_two_samples(tmpdir):
+    # the selections of the same name of different samples are kept side by side
+    for sample, seed in (("first", 0), ("second", 1)):
+        makeNtuple(makeColumns(seed)).writeColumnarStore(str(tmpdir.join(sample)))
+    first, second = HGCalNtuple(str(tmpdir.join("first"))), HGCalNtuple(str(tmpdir.join("second")))
+    firstEntries = first.build_selection("selected", selectWithGenParticles, directory=str(tmpdir)).tolist()
+    secondEntries = second.build_selection("selected", selectWithRecHits, ["rechit"], directory=str(tmpdir)).tolist()
+    assert firstEntries != secondEntries
+    assert len(tmpdir.listdir(lambda path: path.basename.endswith(".selection.npz"))) == 2
+    assert HGCalNtuple(str(tmpdir.join("first"))).loadSelection("selected", directory=str(tmpdir)).tolist() == firstEntries
+    assert HGCalNtuple(str(tmpdir.join("second"))).loadSelection("selected", directory=str(tmpdir)).tolist() == secondEntries
+
+
+def sumRecHitEnergies(ntuple, start, stop):
+    return sum(float(chunk.column("rechit", "energy").sum()) for chunk in ntuple.iterate_chunks(["rechit"], 4, start, stop))
+
+
+def add(first, second):
+    return first + second
+
+
+@pytest.mark.parametrize("nWorkers", [1, 2])
+def test_map_reduce(tmpdir, nWorkers):
+    columns = makeColumns()
+    ntuple = makeNtuple(columns)
+    directory = str(tmpdir.join("store"))
+    ntuple.writeColumnarStore(directory)
+    stored = HGCalNtuple(directory)
+    expected = sum(float(energies.sum()) for energies in columns["rechit_energy"])
+    assert stored.map_reduce(sumRecHitEnergies, add, n_workers=nWorkers, n_blocks=3) == pytest.approx(expected)
+    # with a selection, only the selected entries are processed
+    stored.setSelection([0, 5, 6, 11])
+    expected = sum(float(columns["rechit_energy"][entry].sum()) for entry in [0, 5, 6, 11])
+    assert stored.map_reduce(sumRecHitEnergies, add, n_workers=nWorkers, n_blocks=3) == pytest.approx(expected)